@@ -0,0 +1,36 @@
+# atomic writes of the files of the pipeline (feature store, journals, manifests, shards, caches, models, reports): a
+# file is written to a temporary file next to it first, then renamed over it, so that a crash or a reader running at
+# the same time never sees a partially written file
+import json
+import os
+
+
+def atomic_write(file_path, writer):
+    """
+    :param file_path: path to the file
+    :param writer: function(tmp_file) writing the whole content of the file to the path tmp_file
+    :return: file_path; the temporary file is removed if the writer fails, file_path is then left as it was
+    """
+    tmp_file = file_path + '.tmp'
+    try:
+        writer(tmp_file)
+        os.replace(tmp_file, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return file_path
+
+
+def atomic_write_json(file_path, data, **kwargs):
+    """
+    :param file_path: path to the json file
+    :param data: object to save
+    :param kwargs: arguments of json.dump, ex: indent=1
+    :return: file_path
+    """
+    def write_json(tmp_file):
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, **kwargs)
+
+    return atomic_write(file_path, write_json)
@@ -4,6 +4,16 @@ import os
 img_rows = 100
 img_cols = 100
 osm_features = 56
+sen2_batch_size = 256  # number of sen2 patches reduced together in one vectorized call
+manifest_threads = 32  # number of threads listing the class folders when building the patch manifest
+prefetch_threads = 8  # number of threads decoding the patches ahead of the feature reductions
+prefetch_depth = 64  # maximum number of patches decoded ahead, bounds the memory of the prefetch queue
+staging_threads = 16  # number of threads copying the patches to the node local staging folder
+shard_chunk_size = 4096  # maximum number of patches per chunk of the packed shard archive
+feature_code_version = 1  # version of the feature extraction, increase it when a feature changes to recompute them
+raster_benchmark_patches = 16  # number of patches of a modality the raster decode backends are timed on
+batch_size = 64  # number of patches per mini-batch of the streaming batch iterator
+batch_prefetch_depth = 8  # maximum number of mini-batches loaded ahead, bounds the memory of the batch iterator
 
 # paths to the current folder
 current_dir_path = os.getcwd()
@@ -0,0 +1,79 @@
+# feature specification: maps the covariates a model uses to the data folders and statistics that produce them, so
+# that the feature engineering reads and reduces only what is needed
+import hashlib
+import os
+
+# statistics of the sen2 features, in the order returned by sen2_batch_statistics
+sen2_statistics = ['MEAN', 'MED', 'STD', 'MAX', 'MIN']
+sen2_season_folders = {'AUT': 'sen2_rgb_autumn', 'SPR': 'sen2_rgb_spring', 'SUM': 'sen2_rgb_summer',
+                       'WIN': 'sen2_rgb_winter'}
+
+
+def covariate_data(covariate):
+    """
+    :param covariate: name of a feature column, ex: 'SEN2_AUT_MED_R', 'LU_2_A', 'highway'
+    :return: name of the data folder the feature is computed from, every unknown name is an osm feature key
+    """
+    if covariate == 'LCZ_CL':
+        return 'lcz'
+    if covariate.startswith('LU_'):
+        return 'lu'
+    if covariate.startswith('VIIRS_'):
+        return 'viirs'
+    if covariate.startswith('DEM_'):
+        return 'dem'
+    if covariate.startswith('SEN2_') and covariate.split('_')[1] in sen2_season_folders:
+        return sen2_season_folders[covariate.split('_')[1]]
+    return 'osm_features'
+
+
+def feature_spec(covariates):
+    """
+    :param covariates: list of the feature columns to compute, None for all of them
+    :return: dictionary data folder name -> set of its feature columns to compute, None for all the features
+    """
+    if covariates is None:
+        return None
+    spec = {}
+    for covariate in covariates:
+        spec.setdefault(covariate_data(covariate), set()).add(covariate)
+    return spec
+
+
+def spec_sen2_statistics(columns):
+    """
+    :param columns: set of sen2 feature columns of a season
+    :return: set of the sen2 statistics needed for the columns, ex: {'MEAN', 'STD'}
+    """
+    return {column.split('_')[2] for column in columns}
+
+
+def spec_fingerprint(spec):
+    """
+    :param spec: feature specification, as returned by feature_spec
+    :return: sha1 of the feature columns of the specification, None for all the features
+    """
+    if spec is None:
+        return None
+    columns = sorted(column for data_columns in spec.values() for column in data_columns)
+    return hashlib.sha1('\n'.join(columns).encode()).hexdigest()
+
+
+def read_covariates(file_path):
+    """
+    :param file_path: path to a covariate file, one feature column per line, as written by write_covariates
+    :return: list of the feature columns
+    """
+    with open(file_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_covariates(covariates, file_path):
+    """
+    :param covariates: list of the feature columns, ex: list_covar of a trained model
+    :param file_path: path to the covariate file
+    :return: None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    with open(file_path, 'w') as f:
+        f.write('\n'.join(covariates) + '\n')
@@ -0,0 +1,259 @@
+# columnar store of the city features: one uncompressed Arrow IPC (feather) file per split and city, read with
+# column projection, city filtering and memory mapping. Falls back to the pickle files when pyarrow is missing.
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from atomic_io import atomic_write, atomic_write_json
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+    from pyarrow import fs
+except ImportError:
+    pa = None
+
+feature_file_suffix = '_features.arrow' if pa is not None else '_features.pkl'
+
+
+def city_feature_file(feature_folder_city):
+    """
+    :param feature_folder_city: path to the feature folder of a city, ex: So2Sat_POP_features/train/city_name
+    :return: path to the feature file of the city in the current store format
+    """
+    city_name = os.path.basename(os.path.normpath(feature_folder_city))
+    return os.path.join(feature_folder_city, city_name + feature_file_suffix)
+
+
+def find_city_feature_file(feature_folder_city):
+    """
+    :param feature_folder_city: path to the feature folder of a city
+    :return: path to the existing feature file of the city, arrow preferred over pickle, None if there is none
+    """
+    for suffix in ['_features.arrow', '_features.pkl']:
+        city_files = glob.glob(os.path.join(feature_folder_city, '*' + suffix))
+        if city_files and (suffix == '_features.pkl' or pa is not None):
+            return city_files[0]
+    return None
+
+
+def write_city_features(df, feature_folder_city):
+    """
+    Writes the features of a city atomically (see atomic_io.py), readers never see a partially written file
+    :param df: data frame of the city features
+    :param feature_folder_city: path to the feature folder of the city
+    :return: path to the feature file
+    """
+    if pa is not None:
+        writer = partial(feather.write_feather, df.reset_index(drop=True), compression='uncompressed')
+    else:
+        writer = df.to_pickle
+    return atomic_write(city_feature_file(feature_folder_city), writer)
+
+
+def read_city_features(feature_folder_city, columns=None):
+    """
+    :param feature_folder_city: path to the feature folder of a city
+    :param columns: list of columns to read, None for all of them
+    :return: data frame of the city features
+    """
+    feature_file = find_city_feature_file(feature_folder_city)
+    if feature_file is None:
+        raise FileNotFoundError('No feature file found in {}'.format(feature_folder_city))
+    if feature_file.endswith('.arrow'):
+        return feather.read_feather(feature_file, columns=columns, memory_map=True)
+    df = pd.read_pickle(feature_file)
+    return df if columns is None else df[columns]
+
+
+def city_feature_columns(feature_file):
+    """
+    :param feature_file: path to the feature file of a city
+    :return: dictionary column name -> dtype name, in the order of the file, read from the arrow schema only
+    """
+    if feature_file.endswith('.arrow'):
+        return {field.name: str(field.type) for field in city_feature_schema(feature_file)}
+    return {column: str(dtype) for column, dtype in pd.read_pickle(feature_file).dtypes.items()}
+
+
+def city_feature_schema(feature_file):
+    """
+    :param feature_file: path to the arrow feature file of a city
+    :return: arrow schema of the file, read without the data
+    """
+    with pa.memory_map(feature_file) as source:
+        return ipc.open_file(source).schema
+
+
+def append_city_features(feature_folder_city, features):
+    """
+    Appends feature columns to the feature file of a city, the rows are matched on GRD_ID and the other columns are
+    kept as they are. Columns that already exist are replaced.
+    :param feature_folder_city: path to the feature folder of a city
+    :param features: data frame of the new feature columns indexed by GRD_ID
+    :return: number of GRD_ID of the city without a row in features, their new columns are left empty
+    """
+    df = read_city_features(feature_folder_city)
+    features = features[~features.index.duplicated()]
+    missing = ~df['GRD_ID'].isin(features.index)
+    df = df.drop(columns=[column for column in features.columns if column in df.columns])
+    df = pd.concat([df, features.reindex(df['GRD_ID']).reset_index(drop=True)], axis=1)
+    write_city_features(df, feature_folder_city)
+    return int(missing.sum())
+
+
+def schema_file_path(feature_folder):
+    """
+    :param feature_folder: path to the feature folder
+    :return: path to the schema of the feature store
+    """
+    return os.path.join(feature_folder, 'schema.json')
+
+
+def read_schema(feature_folder):
+    """
+    :param feature_folder: path to the feature folder
+    :return: schema of the feature store: {'version': int, 'columns': {name: {'dtype', 'group', 'version'}}}, None
+    if the feature store has no schema yet
+    """
+    schema_file = schema_file_path(feature_folder)
+    if not os.path.isfile(schema_file):
+        return None
+    with open(schema_file) as f:
+        return json.load(f)
+
+
+def register_features(feature_folder, columns, group):
+    """
+    Records feature columns in the schema of the feature store, the schema version is increased when columns are
+    added or their dtype changes
+    :param feature_folder: path to the feature folder
+    :param columns: dictionary column name -> dtype name, see city_feature_columns
+    :param group: name of the group of features the columns belong to, ex: 'base' for the feature engineering
+    :return: schema of the feature store
+    """
+    schema = read_schema(feature_folder) or {'version': 0, 'columns': {}}
+    changed = [column for column, dtype in columns.items()
+               if schema['columns'].get(column, {}).get('dtype') != dtype]
+    if not changed:
+        return schema
+    schema['version'] += 1
+    for column in changed:
+        schema['columns'][column] = {'dtype': columns[column], 'group': group, 'version': schema['version'],
+                                     'added': time.strftime("%Y%m%d-%H%M%S")}
+    atomic_write_json(schema_file_path(feature_folder), schema, indent=1)
+    print('Feature store schema version {}: {} columns of group {} registered'.format(
+        schema['version'], len(changed), group))
+    return schema
+
+
+def feature_names(feature_folder, group=None):
+    """
+    :param feature_folder: path to the feature folder
+    :param group: name of a group of features, None for all the features
+    :return: list of the feature columns registered in the schema, in the order they were added
+    """
+    schema = read_schema(feature_folder)
+    if schema is None:
+        return []
+    return [column for column, info in schema['columns'].items() if group is None or info['group'] == group]
+
+
+def feature_group_names(feature_folder):
+    """
+    :param feature_folder: path to the feature folder
+    :return: sorted names of the groups of features registered in the schema, ex: ['base', 'texture']
+    """
+    schema = read_schema(feature_folder)
+    if schema is None:
+        return []
+    return sorted({info['group'] for info in schema['columns'].values()})
+
+
+def load_features(feature_folder, split, columns=None, cities=None):
+    """
+    :param feature_folder: path to the feature folder
+    :param split: 'train' or 'test'
+    :param columns: list of columns to read by name, None for all of them; when the feature store has a schema, the
+    names are checked against it
+    :param cities: list of city names to read, None for all the cities of the split
+    :return: data frame with the features of all the selected cities, one row per patch; the columns a city does
+    not have are left empty for its rows
+    """
+    schema = read_schema(feature_folder)
+    if schema is not None and columns is not None:
+        unknown = [column for column in columns if column not in schema['columns']]
+        if unknown:
+            raise KeyError('Features {} are not in the feature store {} (schema version {}), compute them with '
+                           'feature_engineering or append_features'.format(unknown, feature_folder,
+                                                                         schema['version']))
+
+    feature_folder_split = os.path.join(feature_folder, split)
+    all_cities = glob.glob(os.path.join(feature_folder_split, '*'))  # get all the cities of the split
+    if cities is not None:
+        all_cities = [each_city for each_city in all_cities if os.path.basename(each_city) in cities]
+    city_files = [find_city_feature_file(each_city) for each_city in all_cities]
+    city_files = [city_file for city_file in city_files if city_file is not None]
+
+    if city_files and all(city_file.endswith('.arrow') for city_file in city_files):
+        # memory mapped reads of the projected columns only, the cities are filtered on the file paths. The schema
+        # is the union of the schemas of all the cities: the columns a city lacks (ex: the dem features of a city
+        # without Part2 patches) are read as null, and a column that is int64 in a city and double in another one
+        # (ex: LCZ_CL with missing patches) is read as double. The columns no city has are left empty
+        schema = pa.unify_schemas([city_feature_schema(city_file) for city_file in city_files],
+                                  promote_options='permissive')
+        dataset = ds.dataset(city_files, schema=schema, format='ipc', filesystem=fs.LocalFileSystem(use_mmap=True))
+        if columns is None:
+            return dataset.to_table().to_pandas()
+        df = dataset.to_table(columns=[column for column in columns if column in schema.names]).to_pandas()
+        return df.reindex(columns=columns)
+
+    # pickle store, read the cities in threads and concatenate once, the columns a city lacks are left empty
+    def read_city_file(city_file):
+        df = read_city_features(os.path.dirname(city_file))
+        return df if columns is None else df.reindex(columns=columns)
+
+    with ThreadPoolExecutor(max_workers=min(len(city_files), 16) or 1) as executor:
+        city_dfs = list(executor.map(read_city_file, city_files))
+    if not city_dfs:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(city_dfs, ignore_index=True)
+
+
+def load_feature_arrays(feature_folder, split, covariates, target=None, cities=None, fill_value=None):
+    """
+    Loads the training or test matrices of the regressors from the feature store in one read: only the needed
+    columns of all the cities, concatenated once
+    :param feature_folder: path to the feature folder
+    :param split: 'train' or 'test'
+    :param covariates: names of the feature columns, in the order of the columns of X
+    :param target: name of the ground truth column, ex: 'POP', None for the test split
+    :param cities: list of city names to read, None for all the cities of the split
+    :param fill_value: value the missing features are replaced with, None keeps them as nan
+    :return: X, C contiguous float32 array of shape (patches, covariates); y, float32 array of the target (None
+    without target); data frame of the CITY and GRD_ID of every row
+    """
+    columns = ['CITY', 'GRD_ID'] + [column for column in covariates if column not in ['CITY', 'GRD_ID']]
+    if target is not None and target not in columns:
+        columns.append(target)
+    df = load_features(feature_folder, split, columns=columns, cities=cities)
+
+    X = np.empty((len(df), len(covariates)), dtype=np.float32)  # C order, one row per patch
+    for k, covariate in enumerate(covariates):
+        X[:, k] = df[covariate].to_numpy(dtype=np.float32, na_value=np.nan)
+    if fill_value is not None:
+        X[np.isnan(X)] = fill_value
+    y = None
+    if target is not None:
+        y = df[target].to_numpy(dtype=np.float32, na_value=np.nan)
+        if fill_value is not None:
+            y[np.isnan(y)] = fill_value
+    return X, y, df[['CITY', 'GRD_ID']].reset_index(drop=True)
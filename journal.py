@@ -0,0 +1,100 @@
+# work journal of the feature engineering: per city, the fingerprints of the input patches of every data folder and
+# the feature code version the city was processed with. Cities whose inputs did not change are skipped on re-runs.
+import hashlib
+import json
+import os
+
+from atomic_io import atomic_write_json
+from constants import feature_code_version
+
+
+def journal_file_path(feature_folder_city):
+    """
+    :param feature_folder_city: path to the feature folder of a city, ex: So2Sat_POP_features/train/city_name
+    :return: path to the journal file of the city
+    """
+    city_name = os.path.basename(os.path.normpath(feature_folder_city))
+    return os.path.join(feature_folder_city, city_name + '_journal.json')
+
+
+def patches_fingerprint(all_patches, manifest=None):
+    """
+    :param all_patches: list of all the patches of a data folder
+    :param manifest: manifest data frame holding the patches, their SIZE and MTIME are used instead of calling
+    os.stat on every patch; the patches it does not hold are still read from the file system
+    :return: fingerprint of the patches: number of patches and sha1 of their class folder, file name, size and mtime
+    """
+    patch_stats = {}
+    if manifest is not None:
+        rows = manifest[manifest['PATH'].isin(all_patches)]
+        patch_stats = dict(zip(rows['PATH'], zip(rows['SIZE'].tolist(), rows['MTIME'].tolist())))
+    lines = []
+    for each_patch in all_patches:
+        if each_patch in patch_stats:
+            size, mtime = patch_stats[each_patch]
+        else:
+            stat = os.stat(each_patch)
+            size, mtime = stat.st_size, stat.st_mtime_ns
+        # class folder and file name only, the fingerprint does not depend on where the dataset is mounted
+        class_folder, file_name = each_patch.split(os.sep)[-2:]
+        lines.append('{}/{}\t{}\t{}'.format(class_folder, file_name, size, mtime))
+    lines.sort()
+    return {'n_patches': len(lines), 'sha1': hashlib.sha1('\n'.join(lines).encode()).hexdigest()}
+
+
+def city_fingerprints(city_patches, manifest=None):
+    """
+    :param city_patches: dictionary data folder path -> list of patches of a city
+    :param manifest: manifest data frame holding the patches of the city, see patches_fingerprint
+    :return: dictionary data folder name -> fingerprint of its patches
+    """
+    return {os.path.basename(os.path.normpath(each_data)): patches_fingerprint(all_patches, manifest)
+            for each_data, all_patches in city_patches.items()}
+
+
+def read_journal(feature_folder_city):
+    """
+    :param feature_folder_city: path to the feature folder of a city
+    :return: journal of the city, None if there is none or it can not be read
+    """
+    journal_file = journal_file_path(feature_folder_city)
+    if not os.path.isfile(journal_file):
+        return None
+    try:
+        with open(journal_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_journal(feature_folder_city, fingerprints, update=False):
+    """
+    Records that the features of a city are complete, written atomically after the feature file so that an
+    interrupted run never leaves a journal of features that were not saved
+    :param feature_folder_city: path to the feature folder of a city
+    :param fingerprints: dictionary data folder name -> fingerprint, as returned by city_fingerprints
+    :param update: if True, the fingerprints are added to the ones already in the journal
+    :return: None
+    """
+    journal_file = journal_file_path(feature_folder_city)
+    if update:
+        journal = read_journal(feature_folder_city)
+        if journal is not None and journal.get('feature_code_version') == feature_code_version:
+            fingerprints = dict(journal.get('data', {}), **fingerprints)
+    atomic_write_json(journal_file, {'feature_code_version': feature_code_version, 'data': fingerprints}, indent=1,
+                      sort_keys=True)
+
+
+def city_is_done(feature_folder_city, fingerprints, feature_file):
+    """
+    :param feature_folder_city: path to the feature folder of a city
+    :param fingerprints: fingerprints of the current inputs of the city, as returned by city_fingerprints
+    :param feature_file: path to the feature file of the city, None if it does not exist
+    :return: True if the features of the city were computed from the same inputs with the same feature code. Data
+    folders recorded in the journal but not in fingerprints are ignored, e.g. dem when only Part1 is checked
+    """
+    journal = read_journal(feature_folder_city)
+    if journal is None or feature_file is None or journal.get('feature_code_version') != feature_code_version:
+        return False
+    done_data = journal.get('data', {})
+    return all(done_data.get(data) == fingerprint for data, fingerprint in fingerprints.items())
@@ -0,0 +1,214 @@
+# persistent index of the So2Sat POP patch files, replaces the nested glob crawls over split, city, data and class
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from atomic_io import atomic_write
+from constants import current_dir_path, manifest_threads
+
+
+def manifest_file_path(part_path):
+    """
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :return: path to the manifest file of the folder, saved in the current folder
+    """
+    part_name = os.path.basename(os.path.normpath(part_path)).replace(' ', '_')
+    return os.path.join(current_dir_path, 'So2Sat_POP_manifest', part_name + '_manifest.npz')
+
+
+def scan_subfolders(folder_path):
+    """
+    :param folder_path: path to a folder
+    :return: list of (name, path, mtime in ns) of the sub folders, in directory order
+    """
+    sub_folders = []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if not entry.name.startswith('.') and entry.is_dir():
+                sub_folders.append((entry.name, entry.path, entry.stat().st_mtime_ns))
+    return sub_folders
+
+
+def scan_class_folder(class_path):
+    """
+    :param class_path: path to a class folder, ex: '.../train/city/lu/Class_3'
+    :return: names, sizes and mtimes (ns) of all the patches in the class folder, in directory order
+    """
+    names = []
+    sizes = []
+    mtimes = []
+    with os.scandir(class_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            names.append(entry.name)
+            sizes.append(stat.st_size)
+            mtimes.append(stat.st_mtime_ns)
+    return names, sizes, mtimes
+
+
+def list_class_folders(part_path):
+    """
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :return: data frame with one row per class folder: SPLIT, CITY, MODALITY, CLASS_FOLDER, DIR_MTIME
+    """
+    folders = []
+    for split, split_path, _ in scan_subfolders(part_path):
+        for city, city_path, _ in scan_subfolders(split_path):
+            for modality, modality_path, _ in scan_subfolders(city_path):
+                for class_folder, _, dir_mtime in scan_subfolders(modality_path):
+                    folders.append((split, city, modality, class_folder, dir_mtime))
+    return pd.DataFrame(folders, columns=['SPLIT', 'CITY', 'MODALITY', 'CLASS_FOLDER', 'DIR_MTIME'])
+
+
+def save_manifest(folders, files, manifest_file):
+    """
+    Saves the manifest as a compressed npz, written atomically so that a crash never leaves a truncated manifest
+    behind
+    :param folders: data frame of the class folders, as returned by list_class_folders
+    :param files: data frame of the patches: FOLDER (row of folders), NAME, SIZE, MTIME
+    :param manifest_file: path to the manifest file
+    :return: None
+    """
+    def write_npz(tmp_file):
+        with open(tmp_file, 'wb') as f:  # a file object, np.savez_compressed would add .npz to a path
+            np.savez_compressed(f,
+                                split=folders['SPLIT'].to_numpy(dtype=str),
+                                city=folders['CITY'].to_numpy(dtype=str),
+                                modality=folders['MODALITY'].to_numpy(dtype=str),
+                                class_folder=folders['CLASS_FOLDER'].to_numpy(dtype=str),
+                                dir_mtime=folders['DIR_MTIME'].to_numpy(dtype=np.int64),
+                                folder=files['FOLDER'].to_numpy(dtype=np.int32),
+                                name=files['NAME'].to_numpy(dtype=str),
+                                size=files['SIZE'].to_numpy(dtype=np.int64),
+                                mtime=files['MTIME'].to_numpy(dtype=np.int64))
+
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    atomic_write(manifest_file, write_npz)
+
+
+def load_manifest_tables(manifest_file):
+    """
+    :param manifest_file: path to the manifest file
+    :return: data frames of the class folders and of the patches, as saved by save_manifest
+    """
+    with np.load(manifest_file) as npz:
+        folders = pd.DataFrame({'SPLIT': npz['split'], 'CITY': npz['city'], 'MODALITY': npz['modality'],
+                                'CLASS_FOLDER': npz['class_folder'], 'DIR_MTIME': npz['dir_mtime']})
+        files = pd.DataFrame({'FOLDER': npz['folder'], 'NAME': npz['name'], 'SIZE': npz['size'],
+                              'MTIME': npz['mtime']})
+    return folders, files
+
+
+def expand_manifest(part_path, folders, files):
+    """
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :param folders: data frame of the class folders
+    :param files: data frame of the patches
+    :return: manifest data frame with one row per patch: SPLIT, CITY, MODALITY, CLASS, GRD_ID, PATH, SIZE, MTIME
+    """
+    folder_paths = (part_path.rstrip(os.sep) + os.sep + folders['SPLIT'] + os.sep + folders['CITY'] + os.sep
+                    + folders['MODALITY'] + os.sep + folders['CLASS_FOLDER'] + os.sep)
+    folder_of_file = files['FOLDER'].to_numpy()
+    manifest = pd.DataFrame({
+        'SPLIT': pd.Categorical(folders['SPLIT'].to_numpy()[folder_of_file]),
+        'CITY': pd.Categorical(folders['CITY'].to_numpy()[folder_of_file]),
+        'MODALITY': pd.Categorical(folders['MODALITY'].to_numpy()[folder_of_file]),
+        'CLASS': pd.Categorical(folders['CLASS_FOLDER'].str.rsplit('_').str[1].to_numpy()[folder_of_file]),
+        'GRD_ID': files['NAME'].str.split('_').str[0],  # ID of the grid cell, as in get_id_response_var_test
+        'PATH': folder_paths.to_numpy()[folder_of_file] + files['NAME'].to_numpy(),
+        'SIZE': files['SIZE'].to_numpy(),
+        'MTIME': files['MTIME'].to_numpy(),
+    })
+    return manifest
+
+
+def build_manifest(part_path, manifest_file=None, n_threads=manifest_threads, refresh=True):
+    """
+    Indexes all the patches of So2Sat POP Part1 or Part2 once and keeps the index up to date: class folders whose
+    modification time did not change since the last run are not listed again
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :param manifest_file: path to the manifest file, defaults to manifest_file_path(part_path)
+    :param n_threads: number of threads listing the class folders
+    :param refresh: if False, an existing manifest is returned without checking the folders
+    :return: manifest data frame, as returned by expand_manifest
+    """
+    if manifest_file is None:
+        manifest_file = manifest_file_path(part_path)
+
+    old_folders = None
+    if os.path.isfile(manifest_file):
+        old_folders, old_files = load_manifest_tables(manifest_file)
+        if not refresh:
+            return expand_manifest(part_path, old_folders, old_files)
+
+    folders = list_class_folders(part_path)
+    folder_keys = list(zip(folders['SPLIT'], folders['CITY'], folders['MODALITY'], folders['CLASS_FOLDER']))
+
+    # patches of the class folders that are unchanged since the last manifest
+    reused = {}
+    if old_folders is not None:
+        old_keys = zip(old_folders['SPLIT'], old_folders['CITY'], old_folders['MODALITY'],
+                       old_folders['CLASS_FOLDER'], old_folders['DIR_MTIME'])
+        old_index = {(split, city, modality, class_folder): (i, dir_mtime)
+                     for i, (split, city, modality, class_folder, dir_mtime) in enumerate(old_keys)}
+        old_groups = old_files.groupby('FOLDER', sort=False).indices
+        for i, key in enumerate(folder_keys):
+            if key in old_index and old_index[key][1] == folders['DIR_MTIME'].iat[i]:
+                rows = old_files.iloc[old_groups.get(old_index[key][0], [])]
+                reused[i] = (rows['NAME'].tolist(), rows['SIZE'].tolist(), rows['MTIME'].tolist())
+
+    to_scan = [i for i in range(len(folder_keys)) if i not in reused]
+    class_paths = [os.path.join(part_path, *folder_keys[i]) for i in to_scan]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        scanned = dict(zip(to_scan, executor.map(scan_class_folder, class_paths)))
+
+    names = []
+    sizes = []
+    mtimes = []
+    folder_of_file = []
+    for i in range(len(folder_keys)):
+        folder_names, folder_sizes, folder_mtimes = reused[i] if i in reused else scanned[i]
+        names.extend(folder_names)
+        sizes.extend(folder_sizes)
+        mtimes.extend(folder_mtimes)
+        folder_of_file.extend([i] * len(folder_names))
+    files = pd.DataFrame({'FOLDER': np.array(folder_of_file, dtype=np.int32), 'NAME': names,
+                          'SIZE': np.array(sizes, dtype=np.int64), 'MTIME': np.array(mtimes, dtype=np.int64)})
+
+    save_manifest(folders, files, manifest_file)
+    print('Manifest of {}: {} patches, {} class folders listed, {} reused'.format(
+        part_path, len(files), len(to_scan), len(reused)))
+    return expand_manifest(part_path, folders, files)
+
+
+def manifest_city_patches(manifest, part_path):
+    """
+    :param manifest: manifest data frame of So2Sat POP Part1 or Part2
+    :param part_path: path to the same So2Sat POP folder
+    :return: dictionary city path -> {data folder path -> list of patches}, in directory order
+    """
+    all_city_patches = {}
+    groups = manifest.groupby(['SPLIT', 'CITY', 'MODALITY'], sort=False, observed=True).indices
+    all_paths = manifest['PATH'].to_numpy()
+    for (split, city, modality), rows in groups.items():
+        each_city = os.path.join(part_path, split, city)
+        city_patches = all_city_patches.setdefault(each_city, {})
+        city_patches[os.path.join(each_city, modality)] = all_paths[rows].tolist()
+    return all_city_patches
+
+
+def manifest_cities(manifest, part_path, split=None):
+    """
+    :param manifest: manifest data frame of So2Sat POP Part1 or Part2
+    :param part_path: path to the same So2Sat POP folder
+    :param split: 'train' or 'test', None for both
+    :return: list of paths to the city folders, in directory order
+    """
+    if split is not None:
+        manifest = manifest[manifest['SPLIT'] == split]
+    pairs = manifest[['SPLIT', 'CITY']].drop_duplicates()
+    return [os.path.join(part_path, split, city) for split, city in zip(pairs['SPLIT'], pairs['CITY'])]
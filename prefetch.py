@@ -0,0 +1,66 @@
+# read-ahead decoding of the patches: GDAL, rasterio and OpenCV release the GIL while reading and decoding, so a few
+# threads decode the next patches while the current ones are reduced. The number of patches decoded ahead is bounded.
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import prefetch_threads, prefetch_depth
+
+
+def new_prefetch_stats():
+    """
+    :return: dictionary accumulating the statistics of prefetch_map calls: number of items, number of times the
+    consumer found the next item not decoded yet (queue starvation) and the time it waited for it
+    """
+    return {'items': 0, 'starved': 0, 'wait': 0.0}
+
+
+def format_prefetch_stats(stats):
+    """
+    :param stats: statistics of prefetch_map calls, as returned by new_prefetch_stats
+    :return: one line summary of the statistics
+    """
+    starved_percent = 100.0 * stats['starved'] / max(stats['items'], 1)
+    return 'prefetch: {} patches, queue empty for {} ({:.0f}%), {:.1f} s waiting on reads'.format(
+        stats['items'], stats['starved'], starved_percent, stats['wait'])
+
+
+def prefetch_map(func, items, n_threads=prefetch_threads, depth=prefetch_depth, stats=None):
+    """
+    Same as map(func, items), but func runs in a thread pool up to depth items ahead of the consumer
+    :param func: function decoding an item, ex: cv2.imread
+    :param items: list of the items, ex: paths to the patches
+    :param n_threads: number of decoding threads, 1 or less calls func in the consumer thread
+    :param depth: maximum number of items decoded ahead of the consumer
+    :param stats: dictionary updated with the statistics of the call, see new_prefetch_stats
+    :return: generator over func(item), in the order of items
+    """
+    if n_threads <= 1:
+        for item in items:
+            if stats is not None:
+                stats['items'] += 1
+            yield func(item)
+        return
+
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    queue = deque()
+    try:
+        queue.extend(executor.submit(func, item) for _, item in zip(range(max(depth, 1)), items))
+        while queue:
+            future = queue.popleft()
+            if stats is not None:
+                stats['items'] += 1
+                if not future.done():  # the consumer is faster than the reads
+                    stats['starved'] += 1
+                    start = time.time()
+                    future.result()
+                    stats['wait'] += time.time() - start
+            for item in items:  # keep the queue full, one new item for the one taken
+                queue.append(executor.submit(func, item))
+                break
+            yield future.result()
+    finally:
+        for future in queue:  # consumer stopped early, drop the reads not started yet (no cancel_futures in 3.8)
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,252 @@
+# integrity preflight of So2Sat POP Part1 and Part2, run before the feature engineering so that a broken tree fails in
+# seconds instead of hours into a job. The patches are listed from the manifests (stat only) and the rasters are
+# checked from their headers, read in a thread pool. The issues are written to a JSON report.
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import rasterio
+
+from atomic_io import atomic_write_json
+from constants import current_dir_path, img_rows, img_cols, manifest_threads
+from manifest import build_manifest, scan_subfolders
+
+# data folders every city is expected to hold, and the number of bands of their rasters
+part_modalities = {'Part1': ['lcz', 'lu', 'osm_features', 'sen2_rgb_autumn', 'sen2_rgb_spring', 'sen2_rgb_summer',
+                             'sen2_rgb_winter', 'viirs'],
+                   'Part2': ['dem']}
+modality_bands = {'lcz': 1, 'lu': 4, 'viirs': 1, 'dem': 1, 'sen2_rgb_autumn': 3, 'sen2_rgb_spring': 3,
+                  'sen2_rgb_summer': 3, 'sen2_rgb_winter': 3}
+
+max_examples = 10  # number of example GRD_ID or paths recorded per issue
+
+
+def preflight_report_path():
+    """
+    :return: path to the preflight report, in the current folder
+    """
+    return os.path.join(current_dir_path, 'So2Sat_POP_preflight.json')
+
+
+def add_issue(issues, severity, check, split, city, modality=None, examples=(), count=None, detail=''):
+    """
+    :param issues: list of the issues found so far, the new issue is appended to it
+    :param severity: 'error' for the issues the feature engineering fails on, 'warning' otherwise
+    :param check: name of the check, ex: 'missing_patches'
+    :param split: 'train' or 'test'
+    :param city: name of the city, None for the issues of a whole split
+    :param modality: name of the data folder, None for the issues of a whole city
+    :param examples: GRD_ID or paths of the affected patches, only the first max_examples are kept
+    :param count: number of affected patches, len(examples) when None
+    :param detail: free text description
+    :return: None
+    """
+    examples = list(examples)
+    issues.append({'severity': severity, 'check': check, 'split': split, 'city': city, 'modality': modality,
+                   'count': len(examples) if count is None else int(count), 'examples': examples[:max_examples],
+                   'detail': detail})
+
+
+def read_city_csv(csv_path):
+    """
+    :param csv_path: path to the csv file of a city
+    :return: data frame of the csv with GRD_ID and Class as strings, None if it can not be read
+    """
+    try:
+        return pd.read_csv(csv_path, dtype={'GRD_ID': str, 'Class': str})
+    except (OSError, ValueError):
+        return None
+
+
+def check_city(split, city, city_df, city_manifests, issues):
+    """
+    Compares the patches of every data folder of a city with its csv: missing and extra patches, patches in another
+    class folder than the csv gives, empty files
+    :param split: 'train' or 'test'
+    :param city: name of the city
+    :param city_df: data frame of the csv of the city, None if it is missing or unreadable
+    :param city_manifests: dictionary part name -> manifest rows of the city in that part
+    :param issues: list the issues are appended to
+    :return: None
+    """
+    if city_df is None:
+        add_issue(issues, 'error', 'city_csv', split, city, detail='csv file missing or unreadable')
+        return
+    if not {'GRD_ID', 'Class', 'POP'}.issubset(city_df.columns):
+        add_issue(issues, 'error', 'city_csv', split, city, detail='csv without GRD_ID, Class and POP columns')
+        return
+    duplicated = city_df['GRD_ID'].duplicated()
+    if duplicated.any():
+        add_issue(issues, 'warning', 'duplicate_grd_id', split, city, examples=city_df['GRD_ID'][duplicated])
+    csv_class = pd.Series(city_df['Class'].to_numpy(), index=city_df['GRD_ID'])
+    csv_class = csv_class[~csv_class.index.duplicated()]
+
+    for part, modalities in part_modalities.items():
+        city_manifest = city_manifests.get(part)
+        if city_manifest is None:
+            continue
+        for data in modalities:
+            rows = city_manifest[city_manifest['MODALITY'] == data]
+            if not len(rows):
+                add_issue(issues, 'error', 'missing_modality', split, city, data, count=len(csv_class),
+                          detail='no {} patch in {}'.format(data, part))
+                continue
+            patch_ids = pd.Index(rows['GRD_ID'])
+            missing = csv_class.index.difference(patch_ids)
+            if len(missing):  # joined on GRD_ID, the features of the data folder are left empty for these rows
+                add_issue(issues, 'warning', 'missing_patches', split, city, data, missing,
+                          detail='GRD_ID of the csv without a patch')
+            extra = patch_ids.difference(csv_class.index)
+            if len(extra):
+                # the other data folders are joined on the GRD_ID of the osm_features patches, their extra patches are
+                # dropped; the ground truth of the extra osm_features patches of the train cities is missing
+                severity = 'error' if data == 'osm_features' and split == 'train' else 'warning'
+                add_issue(issues, severity, 'extra_patches', split, city, data, extra,
+                          detail='patches whose GRD_ID is not in the csv')
+            listed = rows[rows['GRD_ID'].isin(csv_class.index)]
+            wrong_class = listed['CLASS'].astype(str).to_numpy() != csv_class.reindex(listed['GRD_ID']).to_numpy()
+            if wrong_class.any():  # the ground truth is read from the csv on GRD_ID, the class folder is not used
+                add_issue(issues, 'warning', 'class_mismatch', split, city, data, listed['PATH'][wrong_class],
+                          detail='patches in another class folder than the Class of the csv')
+            empty = rows['SIZE'].to_numpy() == 0
+            if empty.any():
+                add_issue(issues, 'error', 'empty_files', split, city, data, rows['PATH'][empty])
+
+
+def read_header(file_path):
+    """
+    :param file_path: path to the patch (raster)
+    :return: (bands, rows, cols, dtype) read from the header of the raster, or the error message if it can not be
+    opened
+    """
+    try:
+        with rasterio.open(file_path, 'r') as ds:
+            return ds.count, ds.height, ds.width, ds.dtypes[0]
+    except Exception as error:  # any decoding error makes the patch unusable
+        return str(error)
+
+
+def check_rasters(manifest, issues, n_threads=manifest_threads):
+    """
+    Reads the header of every raster of the manifest in a thread pool: unreadable rasters, wrong number of bands,
+    patch size other than img_rows x img_cols and dtypes differing within a data folder
+    :param manifest: manifest data frame of So2Sat POP Part1 or Part2
+    :param issues: list the issues are appended to
+    :param n_threads: number of threads reading the headers
+    :return: number of headers read
+    """
+    rasters = manifest[manifest['MODALITY'].isin(list(modality_bands))]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        headers = list(executor.map(read_header, rasters['PATH'], chunksize=256))
+    rasters = rasters.assign(HEADER=headers)
+
+    for (split, city, data), rows in rasters.groupby(['SPLIT', 'CITY', 'MODALITY'], sort=False, observed=True):
+        readable = rows['HEADER'].map(lambda header: not isinstance(header, str)).to_numpy(dtype=bool)
+        if not readable.all():
+            add_issue(issues, 'error', 'unreadable_rasters', split, city, data, rows['PATH'][~readable],
+                      detail=next(header for header in rows['HEADER'] if isinstance(header, str)))
+        headers = rows[readable]
+        if not len(headers):
+            continue
+        bands = headers['HEADER'].map(lambda header: header[0]).to_numpy()
+        if (bands != modality_bands[data]).any():
+            add_issue(issues, 'error', 'unexpected_bands', split, city, data,
+                      headers['PATH'][bands != modality_bands[data]],
+                      detail='expected {} bands'.format(modality_bands[data]))
+        shapes = headers['HEADER'].map(lambda header: header[1:3] != (img_rows, img_cols)).to_numpy(dtype=bool)
+        if shapes.any():
+            add_issue(issues, 'warning', 'unexpected_shape', split, city, data, headers['PATH'][shapes],
+                      detail='not {} x {}, resampled by load_data'.format(img_rows, img_cols))
+        dtypes = headers['HEADER'].map(lambda header: header[3])
+        if dtypes.nunique() > 1:
+            other = (dtypes != dtypes.mode()[0]).to_numpy()
+            add_issue(issues, 'warning', 'mixed_dtypes', split, city, data, headers['PATH'][other],
+                      detail='dtypes {}'.format(sorted(dtypes.unique())))
+    return len(rasters)
+
+
+def preflight(part1_path, part2_path, manifest_part1=None, manifest_part2=None, n_threads=manifest_threads,
+              headers=True, report_file=None):
+    """
+    Checks the So2Sat POP tree before the feature engineering and writes the issues found to a JSON report
+    :param part1_path: path to So2Sat POP Part1 folder
+    :param part2_path: path to So2Sat POP Part2 folder
+    :param manifest_part1: manifest data frame of Part1, built (or refreshed) when None
+    :param manifest_part2: manifest data frame of Part2, built (or refreshed) when None
+    :param n_threads: number of threads reading the city csv files and the raster headers
+    :param headers: if False, the raster headers are not read, only the listing of the patches is checked
+    :param report_file: path to the JSON report, defaults to preflight_report_path()
+    :return: report: {'ok': no error found, 'n_errors', 'n_warnings', 'issues': list of issues, ...}
+    """
+    start = time.time()
+    if manifest_part1 is None:
+        manifest_part1 = build_manifest(part1_path)
+    if manifest_part2 is None:
+        manifest_part2 = build_manifest(part2_path)
+    issues = []
+
+    # cities of both parts, Part2 only holds the dem of the Part1 cities
+    city_groups = {}
+    for part, manifest in [('Part1', manifest_part1), ('Part2', manifest_part2)]:
+        for (split, city), rows in manifest.groupby(['SPLIT', 'CITY'], sort=False, observed=True):
+            city_groups.setdefault((split, city), {})[part] = rows
+    for part, part_path in [('Part1', part1_path), ('Part2', part2_path)]:
+        # cities whose folders hold no patch at all are not in the manifest; hidden folders (ex: .snapshot) are
+        # skipped as in the manifest
+        for split, split_path, _ in sorted(scan_subfolders(part_path)):
+            for city, _, _ in sorted(scan_subfolders(split_path)):
+                city_groups.setdefault((split, city), {}).setdefault(part, manifest_part1.iloc[:0])
+    for (split, city), city_manifests in city_groups.items():
+        for part in part_modalities:
+            if part not in city_manifests:
+                add_issue(issues, 'error', 'city_mismatch', split, city,
+                          detail='city missing from {}'.format(part))
+
+    city_keys = list(city_groups)
+    csv_paths = [os.path.join(part1_path, split, city, city + '.csv') for split, city in city_keys]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        city_dfs = list(executor.map(read_city_csv, csv_paths))
+    for (split, city), city_df in zip(city_keys, city_dfs):
+        check_city(split, city, city_df, city_groups[(split, city)], issues)
+
+    n_headers = 0
+    if headers:
+        n_headers = check_rasters(manifest_part1, issues, n_threads) + check_rasters(manifest_part2, issues, n_threads)
+
+    n_errors = sum(issue['severity'] == 'error' for issue in issues)
+    report = {'ok': n_errors == 0, 'n_errors': n_errors, 'n_warnings': len(issues) - n_errors,
+              'part1_path': part1_path, 'part2_path': part2_path, 'n_cities': len(city_keys),
+              'n_patches': len(manifest_part1) + len(manifest_part2), 'n_headers': n_headers,
+              'seconds': round(time.time() - start, 2), 'issues': issues}
+
+    if report_file is None:
+        report_file = preflight_report_path()
+    atomic_write_json(report_file, report, indent=1)
+
+    print('Preflight of {} cities, {} patches, {} raster headers in {:.1f} s: {} errors, {} warnings, report {}'.format(
+        report['n_cities'], report['n_patches'], n_headers, report['seconds'], n_errors, report['n_warnings'],
+        report_file))
+    for issue in issues[:max_examples]:
+        print('  {severity} {check} {split}/{city}/{modality}: {count} {detail}'.format(**issue))
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Checks So2Sat POP Part1 and Part2 before the feature engineering')
+    parser.add_argument("--data_path_So2Sat_pop_part1", type=str, required=True,
+                        help="Enter the path to So2Sat POP Part1 folder")
+    parser.add_argument("--data_path_So2Sat_pop_part2", type=str, required=True,
+                        help="Enter the path to So2Sat POP Part2 folder")
+    parser.add_argument("--headers", type=int, default=1,
+                        help="Enter if the raster headers are read [1 or 0]")
+    parser.add_argument("--report", type=str, default='',
+                        help="Enter the path to the JSON report, empty for So2Sat_POP_preflight.json")
+    args = parser.parse_args()
+
+    preflight_report = preflight(args.data_path_So2Sat_pop_part1, args.data_path_So2Sat_pop_part2,
+                                 headers=args.headers == 1, report_file=args.report or None)
+    sys.exit(0 if preflight_report['ok'] else 1)
@@ -0,0 +1,191 @@
+# single interface to read the raster patches with interchangeable decoders (GDAL, rasterio, OpenCV). Every backend
+# returns the bands in the order of the file and with the dtype of the file, shape (bands, rows, cols). The backend of
+# each modality is picked by a micro benchmark on a sample of its patches, among the backends that decode them exactly
+# as the reference backend does.
+import os
+import time
+from functools import partial
+
+import cv2
+import numpy as np
+import rasterio
+
+try:
+    from osgeo import gdal
+except ImportError:
+    try:
+        import gdal
+    except ImportError:  # GDAL not installed, the patches are read with rasterio or OpenCV
+        gdal = None
+
+from constants import raster_benchmark_patches
+
+# order of preference when the timings are equal, the first backend that reads the sample is the reference
+raster_backend_names = (['gdal'] if gdal is not None else []) + ['rasterio', 'cv2']
+
+# backend of each modality, filled by select_raster_backend or set_raster_backend
+modality_backends = {}
+
+
+def read_gdal(file_path):
+    """
+    :param file_path: path to the patch (raster)
+    :return: all the bands of the patch read with GDAL, shape (bands, rows, cols)
+    """
+    array = gdal.Open(file_path).ReadAsArray()
+    if array.ndim == 2:  # single band rasters are returned as (rows, cols)
+        array = array[np.newaxis]
+    return array
+
+
+def read_rasterio(file_path):
+    """
+    :param file_path: path to the patch (raster)
+    :return: all the bands of the patch read with rasterio, shape (bands, rows, cols)
+    """
+    with rasterio.open(file_path, 'r') as ds:
+        return ds.read()
+
+
+def read_cv2(file_path):
+    """
+    :param file_path: path to the patch (raster)
+    :return: all the bands of the patch read with OpenCV, shape (bands, rows, cols); the b, g, r(, a) order of
+    OpenCV is turned back into the order of the file
+    """
+    array = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+    if array is None:
+        raise IOError('OpenCV can not decode {}'.format(file_path))
+    if array.ndim == 2:
+        return array[np.newaxis]
+    array = array.transpose(2, 0, 1)
+    if array.shape[0] in (3, 4):
+        array = array[[2, 1, 0] + list(range(3, array.shape[0]))]
+    return np.ascontiguousarray(array)
+
+
+raster_backends = {'rasterio': read_rasterio, 'cv2': read_cv2}
+if gdal is not None:
+    raster_backends['gdal'] = read_gdal
+
+
+def patch_modality(file_path):
+    """
+    :param file_path: path to a patch, ex: '.../train/city_name/lu/Class_3/patch.tif'
+    :return: name of the data folder of the patch, ex: 'lu'
+    """
+    return os.path.basename(os.path.dirname(os.path.dirname(file_path)))
+
+
+def benchmark_raster_backends(sample_patches, backends=None):
+    """
+    Times every backend on the same patches. The patches are first read by every backend, which warms the page cache
+    and checks that each backend returns the same bands and dtype as the reference (first) backend
+    :param sample_patches: list of paths to patches of one modality
+    :param backends: list of backend names, defaults to raster_backend_names
+    :return: dictionary backend name -> seconds per patch, for the backends that read the sample exactly as the
+    reference backend
+    """
+    if backends is None:
+        backends = raster_backend_names
+    reference = None
+    valid = []
+    for backend in backends:
+        try:
+            arrays = [raster_backends[backend](each_patch) for each_patch in sample_patches]
+        except Exception:  # backend not able to decode the patches, ex: band layout not supported by OpenCV
+            continue
+        if reference is None:
+            reference = arrays
+        elif not all(array.dtype == ref.dtype and np.array_equal(array, ref) for array, ref in zip(arrays, reference)):
+            continue
+        valid.append(backend)
+
+    timings = {}
+    for backend in valid:
+        start = time.perf_counter()
+        for each_patch in sample_patches:
+            raster_backends[backend](each_patch)
+        timings[backend] = (time.perf_counter() - start) / max(len(sample_patches), 1)
+    return timings
+
+
+def select_raster_backend(modality, all_patches, n_sample=raster_benchmark_patches):
+    """
+    :param modality: name of the data folder, ex: 'lu'
+    :param all_patches: list of the patches of the modality, the sample is taken evenly across it
+    :param n_sample: number of patches timed
+    :return: name of the fastest backend for the modality, picked once per process and kept in modality_backends
+    """
+    if modality in modality_backends:
+        return modality_backends[modality]
+    step = max(len(all_patches) // max(n_sample, 1), 1)
+    sample_patches = all_patches[::step][:n_sample]
+    timings = benchmark_raster_backends(sample_patches) if len(sample_patches) else {}
+    backend = min(timings, key=timings.get) if timings else raster_backend_names[0]
+    modality_backends[modality] = backend
+    if timings:
+        print('Raster backend of {}: {} ({})'.format(modality, backend, ', '.join(
+            '{} {:.2f} ms'.format(name, 1000 * seconds) for name, seconds in timings.items())))
+    return backend
+
+
+def set_raster_backend(modality, backend):
+    """
+    :param modality: name of the data folder, ex: 'lu'
+    :param backend: name of the backend to use for the modality, see raster_backend_names
+    :return: None
+    """
+    if backend not in raster_backends:
+        raise ValueError('Unknown raster backend {}, expected one of {}'.format(backend, raster_backend_names))
+    modality_backends[modality] = backend
+
+
+def read_modality_patch(file_path, modality):
+    """
+    Reads a patch with the backend of its modality. The backend is picked on a sample of the patches, so a patch it
+    can not decode is read again with the reference backend, which is then used for the rest of the modality
+    :param file_path: path to the patch (raster)
+    :param modality: name of the data folder of the patch
+    :return: all the bands of the patch, shape (bands, rows, cols)
+    """
+    backend = modality_backends[modality]
+    try:
+        return raster_backends[backend](file_path)
+    except Exception:
+        reference = raster_backend_names[0]
+        if backend == reference:
+            raise
+        if modality_backends.get(modality) == backend:
+            modality_backends[modality] = reference
+            print('Raster backend of {}: {} can not decode {}, {} is used from now on'.format(
+                modality, backend, file_path, reference))
+        return raster_backends[reference](file_path)
+
+
+def raster_reader(all_patches, modality=None):
+    """
+    :param all_patches: list of the patches of one modality
+    :param modality: name of the data folder, taken from the path of the first patch when None
+    :return: function file_path -> bands of the patch, shape (bands, rows, cols), with the backend of the modality and
+    the reference backend for the patches it can not decode, see read_modality_patch
+    """
+    if modality is None:
+        modality = patch_modality(all_patches[0]) if len(all_patches) else ''
+    select_raster_backend(modality, all_patches)
+    return partial(read_modality_patch, modality=modality)
+
+
+def read_raster(file_path, backend=None, sample_patches=None):
+    """
+    :param file_path: path to the patch (raster)
+    :param backend: name of the backend, None for the backend selected for the modality of the patch
+    :param sample_patches: patches of the modality the backend is picked on if it is not picked yet, ex: the patches
+    of the data folder in the manifest; None for file_path alone
+    :return: all the bands of the patch, shape (bands, rows, cols)
+    """
+    if backend is not None:
+        return raster_backends[backend](file_path)
+    modality = patch_modality(file_path)
+    select_raster_backend(modality, sample_patches if sample_patches is not None else [file_path])
+    return read_modality_patch(file_path, modality)
@@ -24,6 +24,11 @@ feature_folder='/local_home/trao_ka/projects/helmholtz_challenges/countMeIn/star
 learning_algo=$1
 tuning_method=$2
 training_no_feature=$3 
+# optional node local staging, ex: "$TMPDIR" or /dev/shm; empty reads the data from /p/project
+stage_dir=${4:-}
+# comma separated data folders to stage, ex: lu,lcz,viirs,osm_features; empty stages all of them, the others are read
+# from data_1 and data_2
+stage_modalities=${5:-}
 
 
 echo "Learning method: " $learning_algo
@@ -32,6 +37,8 @@ echo "data path1: " $data_1
 echo "data path2: " $data_2
 echo "Training (and not feature engineering)': " $training_no_feature
 echo "feature folder: " $feature_folder
+echo "stage dir: " $stage_dir
+echo "stage modalities: " $stage_modalities
 
 #srun singularity run /p/project/hai_countmein/countmein_sklearn_1.0.sif  python3 starter-pack-v2.py --data_path_So2Sat_pop_part1  $data_1 --data_path_So2Sat_pop_part2 $data_2 --learning_method $learning_algo --tuning_method $tuning_method --seed 10
 
@@ -43,4 +50,6 @@ python3 starter-pack-v3.py --data_path_So2Sat_pop_part1 $data_1 \
 --tuning_method $tuning_method \
 --seed 10 \
 --training_no_engineering $training_no_feature \
---data_path_feature_folder $feature_folder 
\ No newline at end of file
+--data_path_feature_folder $feature_folder \
+--stage_dir "$stage_dir" \
+--stage_modalities "$stage_modalities" 
\ No newline at end of file
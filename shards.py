@@ -0,0 +1,166 @@
+# packed shard archive of the So2Sat POP patches: the decoded patches of every city and data folder are stacked into a
+# few .npy chunks next to an index (GRD_ID, class, chunk, row), so that reading a city takes a handful of sequential
+# reads instead of one file open per patch. Layout: <shard_folder>/<split>/<city>/<data>/index.npz + chunk_*.npy
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from atomic_io import atomic_write
+from constants import current_dir_path, shard_chunk_size
+
+
+def shard_folder_path():
+    """
+    :return: default path to the shard folder, both So2Sat POP parts are packed into the same folder
+    """
+    return os.path.join(current_dir_path, 'So2Sat_POP_shards')
+
+
+def save_npy(file_path, array):
+    """
+    Saves an array atomically, so that a crash never leaves a truncated chunk behind
+    :param file_path: path to the .npy file
+    :param array: array to save
+    :return: None
+    """
+    def write_npy(tmp_file):
+        with open(tmp_file, 'wb') as f:  # a file object, np.save would add .npy to a path
+            np.save(f, array)
+
+    atomic_write(file_path, write_npy)
+
+
+def write_shards(shard_data, patch_names, patches, fingerprint, chunk_size=shard_chunk_size, osm_keys=None):
+    """
+    Packs the decoded patches of a data folder into chunks of at most chunk_size patches of the same shape and dtype.
+    The index is written last, a shard folder without index is incomplete.
+    :param shard_data: folder of the shards of a data folder, ex: So2Sat_POP_shards/train/city_name/lu
+    :param patch_names: list of 'class folder/file name' of the patches, in the order of patches
+    :param patches: iterable over the decoded patches, rasters as (bands, rows, cols), osm features as 1D arrays
+    :param fingerprint: fingerprint of the source patches, see journal.patches_fingerprint
+    :param chunk_size: maximum number of patches per chunk
+    :param osm_keys: list of the osm feature keys, for the osm_features data folder
+    :return: number of chunks written
+    """
+    os.makedirs(shard_data, exist_ok=True)
+    chunk_of_patch = []
+    row_of_patch = []
+    chunk = None
+    n_chunk = 0
+    n_chunks = 0
+    for each_patch in patches:
+        if chunk is not None and (n_chunk == chunk_size or each_patch.shape != chunk.shape[1:]
+                                  or each_patch.dtype != chunk.dtype):
+            save_npy(os.path.join(shard_data, 'chunk_{:05d}.npy'.format(n_chunks)), chunk[:n_chunk])
+            n_chunks += 1
+            chunk = None
+        if chunk is None:
+            chunk = np.empty((chunk_size,) + each_patch.shape, dtype=each_patch.dtype)
+            n_chunk = 0
+        chunk[n_chunk] = each_patch
+        chunk_of_patch.append(n_chunks)
+        row_of_patch.append(n_chunk)
+        n_chunk += 1
+    if chunk is not None:
+        save_npy(os.path.join(shard_data, 'chunk_{:05d}.npy'.format(n_chunks)), chunk[:n_chunk])
+        n_chunks += 1
+
+    names = np.array(patch_names, dtype=str)
+    file_names = np.array([name.split('/')[-1] for name in patch_names], dtype=str)
+    class_folders = np.array([name.split('/')[0] for name in patch_names], dtype=str)
+
+    def write_index(tmp_file):
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, name=names,
+                     grd_id=np.array([file_name.rsplit('_')[0] for file_name in file_names], dtype=str),
+                     class_folder=class_folders,
+                     chunk=np.array(chunk_of_patch, dtype=np.int32), row=np.array(row_of_patch, dtype=np.int32),
+                     n_chunks=n_chunks, fingerprint_n=fingerprint['n_patches'], fingerprint_sha1=fingerprint['sha1'],
+                     osm_keys=np.array(osm_keys if osm_keys is not None else [], dtype=str))
+
+    atomic_write(os.path.join(shard_data, 'index.npz'), write_index)
+
+    # chunks of a previous, larger packing of the data folder
+    for chunk_file in glob.glob(os.path.join(shard_data, 'chunk_*.npy')):
+        if int(os.path.basename(chunk_file)[6:11]) >= n_chunks:
+            os.remove(chunk_file)
+    return n_chunks
+
+
+def read_shard_index(shard_data):
+    """
+    :param shard_data: folder of the shards of a data folder
+    :return: data frame with one row per patch: NAME, GRD_ID, CLASS_FOLDER, CHUNK, ROW, and a dictionary with the
+    number of chunks, the fingerprint of the source patches and the osm feature keys
+    """
+    with np.load(os.path.join(shard_data, 'index.npz')) as npz:
+        index = pd.DataFrame({'NAME': npz['name'], 'GRD_ID': npz['grd_id'], 'CLASS_FOLDER': npz['class_folder'],
+                              'CHUNK': npz['chunk'], 'ROW': npz['row']})
+        info = {'n_chunks': int(npz['n_chunks']),
+                'fingerprint': {'n_patches': int(npz['fingerprint_n']), 'sha1': str(npz['fingerprint_sha1'])},
+                'osm_keys': npz['osm_keys'].tolist()}
+    return index, info
+
+
+def shard_fingerprint(shard_data):
+    """
+    :param shard_data: folder of the shards of a data folder
+    :return: fingerprint of the source patches the shards were packed from, None if the shards are incomplete
+    """
+    if not os.path.isfile(os.path.join(shard_data, 'index.npz')):
+        return None
+    return read_shard_index(shard_data)[1]['fingerprint']
+
+
+def load_shard_chunks(shard_data, n_chunks):
+    """
+    :param shard_data: folder of the shards of a data folder
+    :param n_chunks: number of chunks, as given by read_shard_index
+    :return: list of the memory mapped chunks, each of shape (patches, ...) as packed by write_shards
+    """
+    return [np.load(os.path.join(shard_data, 'chunk_{:05d}.npy'.format(k)), mmap_mode='r') for k in range(n_chunks)]
+
+
+def shard_rows(shard_data, grd_ids):
+    """
+    :param shard_data: folder of the shards of a data folder
+    :param grd_ids: list of GRD_ID to read
+    :return: array of the patches of grd_ids, in the order of grd_ids, all the patches must have the same shape
+    """
+    index, info = read_shard_index(shard_data)
+    index = index[~index['GRD_ID'].duplicated()]
+    positions = pd.Index(index['GRD_ID']).get_indexer(grd_ids)
+    if (positions == -1).any():
+        missing = [grd_id for grd_id, position in zip(grd_ids, positions) if position == -1]
+        raise ValueError('GRD_ID of {} patches not found in {}: {}'.format(len(missing), shard_data, missing))
+    chunks = load_shard_chunks(shard_data, info['n_chunks'])
+    patch_chunk = index['CHUNK'].to_numpy()[positions]
+    patch_row = index['ROW'].to_numpy()[positions]
+    rows = np.empty((len(positions),) + chunks[0].shape[1:], dtype=chunks[0].dtype) if chunks else np.empty(0)
+    for k, each_chunk in enumerate(chunks):
+        in_chunk = np.flatnonzero(patch_chunk == k)
+        if len(in_chunk):
+            rows[in_chunk] = each_chunk[patch_row[in_chunk]]
+    return rows
+
+
+def shard_patch_paths(shard_data):
+    """
+    :param shard_data: folder of the shards of a data folder
+    :return: list of the paths of the patches as if they were files in shard_data, ex:
+    So2Sat_POP_shards/train/city_name/lu/Class_3/<GRD_ID>_lu.tif, in the order of the shards. The paths can be parsed
+    by get_id_response_var_test and get_id_response_var_train
+    """
+    index, _ = read_shard_index(shard_data)
+    return (shard_data + os.sep + index['NAME'].str.replace('/', os.sep)).tolist()
+
+
+def list_city_shards(shard_city):
+    """
+    :param shard_city: path to the shard folder of a city
+    :return: list of the complete shard folders of the city, one per data folder
+    """
+    return [shard_data for shard_data in sorted(glob.glob(os.path.join(shard_city, '*')))
+            if os.path.isfile(os.path.join(shard_data, 'index.npz'))]
@@ -0,0 +1,155 @@
+# node local staging of So2Sat POP: copies the needed splits and data folders from the shared file system to a local
+# disk or /dev/shm with parallel copy threads, so that the feature engineering does not read the small patch files
+# over the network. Unchanged files of a previous staging are kept.
+import os
+import shutil
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from constants import staging_threads
+
+
+def list_stage_files(part_path, splits=None, modalities=None, manifest=None):
+    """
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :param splits: list of the splits to stage, ex: ['train'], None for all of them
+    :param modalities: list of the data folders to stage, ex: ['lu', 'osm_features'], None for all of them
+    :param manifest: manifest data frame of the folder (see manifest.build_manifest), used instead of listing the
+    patches from the file system
+    :return: list of (path relative to part_path, size) of the files to stage, the city csv files included
+    """
+    stage_files = []
+    with os.scandir(part_path) as split_entries:
+        for split_entry in split_entries:
+            if not split_entry.is_dir() or (splits is not None and split_entry.name not in splits):
+                continue
+            with os.scandir(split_entry.path) as city_entries:
+                for city_entry in city_entries:
+                    if not city_entry.is_dir():
+                        continue
+                    with os.scandir(city_entry.path) as data_entries:
+                        for data_entry in data_entries:
+                            relative_path = os.path.join(split_entry.name, city_entry.name, data_entry.name)
+                            if data_entry.is_file():  # city csv
+                                stage_files.append((relative_path, data_entry.stat().st_size))
+                            elif manifest is None and (modalities is None or data_entry.name in modalities):
+                                for class_entry in os.scandir(data_entry.path):
+                                    for patch_entry in os.scandir(class_entry.path):
+                                        stage_files.append((os.path.join(relative_path, class_entry.name,
+                                                                         patch_entry.name),
+                                                            patch_entry.stat().st_size))
+
+    if manifest is not None:
+        if splits is not None:
+            manifest = manifest[manifest['SPLIT'].isin(splits)]
+        if modalities is not None:
+            manifest = manifest[manifest['MODALITY'].isin(modalities)]
+        prefix_length = len(part_path.rstrip(os.sep)) + 1
+        stage_files.extend(zip(manifest['PATH'].str[prefix_length:], manifest['SIZE'].tolist()))
+    return stage_files
+
+
+def file_checksum(file_path):
+    """
+    :param file_path: path to a file
+    :return: crc32 of the file content
+    """
+    checksum = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            checksum = zlib.crc32(block, checksum)
+    return checksum
+
+
+def stage_file(source_file, stage_file_path, size, checksum=False):
+    """
+    Copies a file unless the staged copy has the same size and mtime, and checks the copy
+    :param source_file: path to the file on the shared file system
+    :param stage_file_path: path to the staged copy
+    :param size: expected size of the file
+    :param checksum: if True, the crc32 of the copy is compared to the one of the source, otherwise only the size
+    :return: number of bytes copied, 0 if the staged copy was up to date
+    """
+    if os.path.isfile(stage_file_path):
+        source_stat = os.stat(source_file)
+        stage_stat = os.stat(stage_file_path)
+        if stage_stat.st_size == source_stat.st_size and stage_stat.st_mtime_ns == source_stat.st_mtime_ns:
+            return 0
+    os.makedirs(os.path.dirname(stage_file_path), exist_ok=True)
+    shutil.copy2(source_file, stage_file_path)  # keeps the mtime, the feature journal stays valid on the copy
+    if os.path.getsize(stage_file_path) != size or (checksum and
+                                                     file_checksum(stage_file_path) != file_checksum(source_file)):
+        os.remove(stage_file_path)
+        raise IOError('Staged copy of {} is corrupt'.format(source_file))
+    return size
+
+
+def stage_dataset(part_path, stage_dir, splits=None, modalities=None, manifest=None, n_threads=staging_threads,
+                  checksum=False):
+    """
+    Stages So2Sat POP Part1 or Part2 to stage_dir/<folder name of part_path>, the name is kept since the feature
+    engineering tells Part1 and Part2 apart by their folder names
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :param stage_dir: path to the node local folder, ex: $TMPDIR or /dev/shm
+    :param splits: list of the splits to stage, None for all of them
+    :param modalities: list of the data folders to stage, None for all of them
+    :param manifest: manifest data frame of the folder, used instead of listing the patches from the file system
+    :param n_threads: number of copy threads
+    :param checksum: if True, every copy is checked with crc32, otherwise with its size
+    :return: path to the staged folder; IOError before any copy if stage_dir has not enough free space for the files
+    that are not staged yet
+    """
+    staged_path = os.path.join(stage_dir, os.path.basename(os.path.normpath(part_path)))
+    start = time.time()
+    stage_files = list_stage_files(part_path, splits, modalities, manifest)
+
+    # bytes still to copy, the copies of a previous staging with the same size are kept by stage_file
+    needed = sum(size for relative_path, size in stage_files
+                 if not os.path.isfile(os.path.join(staged_path, relative_path))
+                 or os.path.getsize(os.path.join(staged_path, relative_path)) != size)
+    os.makedirs(stage_dir, exist_ok=True)
+    free = shutil.disk_usage(stage_dir).free
+    if needed > free:
+        raise IOError('Staging {} needs {:.1f} GB but {} has {:.1f} GB free, stage fewer data folders (modalities) '
+                      'or splits'.format(part_path, needed / 1e9, stage_dir, free / 1e9))
+
+    def copy_one(stage_entry):
+        relative_path, size = stage_entry
+        return stage_file(os.path.join(part_path, relative_path), os.path.join(staged_path, relative_path), size,
+                          checksum)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        copied = list(executor.map(copy_one, stage_files))
+
+    elapsed = time.time() - start
+    n_copied = sum(1 for n_bytes in copied if n_bytes > 0)
+    mb_copied = sum(copied) / 1e6
+    print('Staged {} to {}: {} files copied ({:.1f} MB), {} up to date, {:.1f} s, {:.1f} MB/s, {:.0f} files/s'.format(
+        part_path, staged_path, n_copied, mb_copied, len(stage_files) - n_copied, elapsed,
+        mb_copied / max(elapsed, 1e-9), n_copied / max(elapsed, 1e-9)))
+    return staged_path
+
+
+def staged_manifest(manifest, part_path, staged_path, splits=None, modalities=None):
+    """
+    :param manifest: manifest data frame of part_path
+    :param part_path: path to So2Sat POP Part1 or Part2 folder
+    :param staged_path: path to the staged copy, as returned by stage_dataset
+    :param splits: list of the staged splits, None for all of them
+    :param modalities: list of the staged data folders, None for all of them
+    :return: manifest of the staged copy, without listing it again. The patches of the data folders that were not
+    staged keep their path in part_path, the feature engineering reads them from the shared file system; the splits
+    that were not staged are left out
+    """
+    if splits is not None:
+        manifest = manifest[manifest['SPLIT'].isin(splits)]
+    manifest = manifest.reset_index(drop=True)
+    staged_paths = staged_path.rstrip(os.sep) + manifest['PATH'].str[len(part_path.rstrip(os.sep)):]
+    if modalities is None:
+        manifest['PATH'] = staged_paths
+    else:
+        manifest['PATH'] = np.where(manifest['MODALITY'].isin(modalities), staged_paths, manifest['PATH'])
+    return manifest
@@ -2,21 +2,14 @@
 import os
 import argparse
 import pdb
- 
-try:
-    from osgeo import gdal
-    from osgeo import osr, ogr
-except:
-    import gdal
-    import osr
 
-from utils import feature_engineering, validation_reg, get_perf
+from utils import feature_engineering, pack_shards, validation_reg, get_perf
+from manifest import build_manifest
+from staging import stage_dataset, staged_manifest
+from preflight import preflight
+from feature_spec import read_covariates
 
-from rf_regression import rf_regressor
-from adaboost_regression import adaboost_regressor
-from gradientboosting_regression import gradientboosting_regressor
-from voting_regression import voting_regressor
-from mlp_regression import mlp_regressor
+from training_engine import train_regressors, learners, tuning_strategies
 
 if __name__ == "__main__":
 
@@ -31,11 +24,11 @@ if __name__ == "__main__":
     
     parser.add_argument(
         "--learning_method", required=True,
-        type=str, help="Enter the learning algorithm to use within: ['random_forest', 'adaboost', 'gradient_boosting', 'voting', 'mlp']")
+        type=str, help="Enter the learning algorithm to use within: ['random_forest', 'adaboost', 'gradient_boosting', 'voting', 'mlp'], or several of them separated by commas, trained on the same data in one run")
     
     parser.add_argument(
         "--tuning_method", required=True,
-        type=str, help="Enter the HPO tuning algorithm to use within: ['grid', 'halving']")
+        type=str, help="Enter the HPO tuning algorithm to use within: ['grid', 'halving', 'warm_grid'], or several separated by a comma")
     
     parser.add_argument(
         "--seed", required=True,
@@ -48,14 +41,79 @@ if __name__ == "__main__":
     parser.add_argument(
         "--data_path_feature_folder", required=False,
         type=str, help="Enter the path to the feature folder")
+
+    parser.add_argument(
+        "--n_workers_features", required=False, type=int, default=1,
+        help="Enter the number of processes the cities are spread over during the feature engineering")
+
+    parser.add_argument(
+        "--use_manifest", required=False, type=int, default=1,
+        help="Enter if the patches are listed from the patch manifest instead of the file system [1 or 0]")
+
+    parser.add_argument(
+        "--resume_features", required=False, type=int, default=1,
+        help="Enter if the cities already processed from unchanged patches are skipped [1 or 0]")
+
+    parser.add_argument(
+        "--use_shards", required=False, type=int, default=0,
+        help="Enter if the patches are packed into the shard archive and the features computed from it [1 or 0]")
+
+    parser.add_argument(
+        "--stage_dir", required=False, type=str, default='',
+        help="Enter a node local folder (ex: $TMPDIR or /dev/shm) the data are copied to before the feature "
+             "engineering, empty to read them from their location")
+
+    parser.add_argument(
+        "--stage_modalities", required=False, type=str, default='',
+        help="Enter the comma separated data folders to stage, of Part1 and Part2, ex: lu,lcz,osm_features, empty "
+             "for all of them; the other data folders are read from their location through the manifests")
+
+    parser.add_argument(
+        "--feature_decimation", required=False, type=int, default=1,
+        help="Enter 1 for the exact features, d > 1 for approximate features from every d-th pixel of the patches; "
+             "the patches are still decoded in full, measured 1.2x to 1.4x faster than the exact features")
+
+    parser.add_argument(
+        "--decimation_error_cities", required=False, type=int, default=3,
+        help="Enter the number of cities the approximate features are compared with the exact ones on")
+
+    parser.add_argument(
+        "--covariates_file", required=False, type=str, default='',
+        help="Enter the path to a covariate file saved with a trained model (*_covariates.txt), only these "
+             "features are computed, to So2Sat_POP_features_covariates_<sha1>; empty for all the features")
+
+    parser.add_argument(
+        "--feature_splits", required=False, type=str, default='',
+        help="Enter the comma separated splits the features are computed for, ex: test, empty for train and test")
+
+    parser.add_argument(
+        "--feature_groups", required=False, type=str, default='',
+        help="Enter the comma separated groups of features added with append_features the regressors select from, "
+             "on top of the covariates of constants.py, ex: texture; empty for these covariates only")
+
+    parser.add_argument(
+        "--preflight", required=False, type=int, default=1,
+        help="Enter if the dataset is checked before the feature engineering, which stops on errors [1 or 0]")
  
     args = parser.parse_args()
     
-    learning_method = args.learning_method
-    tuning_method = args.tuning_method
+    learning_methods = args.learning_method.split(',')
+    tuning_methods = args.tuning_method.split(',')
     seed = args.seed
     training_no_engineering = args.training_no_engineering
     data_path_feature_folder = args.data_path_feature_folder
+    n_workers_features = args.n_workers_features
+    use_manifest = args.use_manifest
+    resume_features = args.resume_features
+    use_shards = args.use_shards
+    stage_dir = args.stage_dir
+    stage_modalities = args.stage_modalities.split(',') if args.stage_modalities else None
+    feature_decimation = args.feature_decimation
+    decimation_error_cities = args.decimation_error_cities
+    covariates = read_covariates(args.covariates_file) if args.covariates_file else None
+    feature_splits = args.feature_splits.split(',') if args.feature_splits else None
+    preflight_check = args.preflight
+    feature_groups = args.feature_groups.split(',') if args.feature_groups else None
     
     all_patches_mixed_part1 = args.data_path_So2Sat_pop_part1
     all_patches_mixed_part2 = args.data_path_So2Sat_pop_part2
@@ -69,60 +127,70 @@ if __name__ == "__main__":
     print('\nPath to So2Sat POP Part1: ', all_patches_mixed_part1)
     print('Path to So2Sat POP Part2: ', all_patches_mixed_part2)
     
-    assert learning_method in ['random_forest', 'adaboost', 'gradient_boosting', 'voting', 'mlp']
-    assert tuning_method in ['grid', 'halving']
+    assert all(learning_method in learners for learning_method in learning_methods)
+    assert all(tuning_method in tuning_strategies for tuning_method in tuning_methods)
     assert training_no_engineering in [1, 0]
     if training_no_engineering == 1:
         assert len(data_path_feature_folder) > 0
+    assert feature_decimation >= 1
+    assert feature_decimation == 1 or use_shards == 0
     #pdb.set_trace()
     
     if training_no_engineering == 0:
         # create features for training and testing data from So2Sat POP Part1 and So2Sat POP Part2
-        feature_folder = feature_engineering(all_patches_mixed_part1)
-        feature_folder = feature_engineering(all_patches_mixed_part2)
+        # the manifests locate the data folders that are not staged, partial staging needs them
+        partial_staging = bool(stage_dir) and stage_modalities is not None
+        manifest_part1 = build_manifest(all_patches_mixed_part1) if use_manifest == 1 or partial_staging else None
+        manifest_part2 = build_manifest(all_patches_mixed_part2) if use_manifest == 1 or partial_staging else None
+        if preflight_check == 1:
+            # fail now rather than hours into the feature engineering
+            preflight_report = preflight(all_patches_mixed_part1, all_patches_mixed_part2, manifest_part1,
+                                         manifest_part2)
+            if not preflight_report['ok']:  # not an assert, the run must stop under python -O as well
+                raise SystemExit('So2Sat POP preflight found {} errors, see So2Sat_POP_preflight.json'.format(
+                    preflight_report['n_errors']))
+        if stage_dir:
+            # copy the data to the node local folder and run the feature engineering on the copy, the data folders
+            # that are not staged are read from their location through the manifests
+            staged_part1 = stage_dataset(all_patches_mixed_part1, stage_dir, modalities=stage_modalities,
+                                         manifest=manifest_part1)
+            staged_part2 = stage_dataset(all_patches_mixed_part2, stage_dir, modalities=stage_modalities,
+                                         manifest=manifest_part2)
+            if manifest_part1 is not None:
+                manifest_part1 = staged_manifest(manifest_part1, all_patches_mixed_part1, staged_part1,
+                                                 modalities=stage_modalities)
+                manifest_part2 = staged_manifest(manifest_part2, all_patches_mixed_part2, staged_part2,
+                                                 modalities=stage_modalities)
+            all_patches_mixed_part1, all_patches_mixed_part2 = staged_part1, staged_part2
+        if use_shards == 1:
+            # pack both parts into the shard archive once, only the changed data folders are packed again
+            shard_folder = pack_shards(all_patches_mixed_part1, n_workers=n_workers_features, manifest=manifest_part1)
+            pack_shards(all_patches_mixed_part2, shard_folder, n_workers=n_workers_features, manifest=manifest_part2)
+            feature_folder = feature_engineering(shard_folder, n_workers=n_workers_features,
+                                                 resume=resume_features == 1, shards=True, covariates=covariates,
+                                                 splits=feature_splits)
+        else:
+            feature_folder = feature_engineering(all_patches_mixed_part1, n_workers=n_workers_features,
+                                                 manifest=manifest_part1, part2_path=all_patches_mixed_part2,
+                                                 manifest_part2=manifest_part2, resume=resume_features == 1,
+                                                 decimation=feature_decimation,
+                                                 error_cities=decimation_error_cities, covariates=covariates,
+                                                 splits=feature_splits)
         print("feature_folder: ", feature_folder)
     
     elif training_no_engineering == 1:
         #elif training_no_engineering:
         feature_folder = data_path_feature_folder
         
-        # Perform regression, ground truth is population count (POP)
-        if learning_method == 'random_forest':
-            prediction_csv = rf_regressor(feature_folder, 
-                                          hp_strategy=tuning_method, 
-                                          seed=seed)
-            
-        elif learning_method == 'adaboost':
-            prediction_csv = adaboost_regressor(feature_folder, 
-                                          hp_strategy=tuning_method, 
-                                          seed=seed)
-            
-        elif learning_method == 'gradient_boosting':
-            prediction_csv = gradientboosting_regressor(feature_folder, 
-                                          hp_strategy=tuning_method, 
-                                          seed=seed)
-            
-        elif learning_method == 'voting':
-            prediction_csv = voting_regressor(feature_folder, 
-                                          hp_strategy=tuning_method, 
-                                          seed=seed)
-            
-        elif learning_method == 'mlp':
-            prediction_csv = mlp_regressor(feature_folder, 
-                                          hp_strategy=tuning_method, 
-                                          seed=seed)
-            
-        else:
-            print('No learning')
-            pass
-        
-        
-        validation_csv_path = prediction_csv.replace('prediction', 'validation')
-        validation_reg(prediction_csv, validation_csv_path, all_patches_mixed_test_part1)
-    
-        mae, rmse, rsq = get_perf(prediction_csv, validation_csv_path, 
-                                  all_patches_mixed_test_part1)
-    
-    
-    
-    
\ No newline at end of file
+        # Perform regression, ground truth is population count (POP); the features are loaded and selected once
+        # for all the learners
+        prediction_csvs = train_regressors(feature_folder, learning_methods, tuning_methods, seed=seed,
+                                           feature_groups=feature_groups)
+
+        for (learning_method, tuning_method), prediction_csv in prediction_csvs.items():
+            print('\nValidation of {} with {} tuning'.format(learning_method, tuning_method))
+            validation_csv_path = prediction_csv.replace('prediction', 'validation')
+            validation_reg(prediction_csv, validation_csv_path, all_patches_mixed_test_part1)
+
+            mae, rmse, rsq = get_perf(prediction_csv, validation_csv_path,
+                                      all_patches_mixed_test_part1)
@@ -0,0 +1,68 @@
+# disk cache of the patch tensors built by load_data and load_osm_data: every tensor is written once into a memory
+# mapped .npy file, keyed by the patches it was built from, and memory mapped again by the next runs instead of
+# decoding and resampling the patches again
+import hashlib
+import os
+
+import numpy as np
+
+from atomic_io import atomic_write
+from constants import current_dir_path
+
+
+def tensor_folder_path():
+    """
+    :return: path to the folder of the cached tensors, in the current folder
+    """
+    return os.path.join(current_dir_path, 'So2Sat_POP_tensors')
+
+
+def tensor_key(f_names, shape, dtype):
+    """
+    :param f_names: paths to the files the tensor is built from, in the order of its rows
+    :param shape: shape of the tensor
+    :param dtype: dtype of the tensor
+    :return: sha1 of the split, city, data and class folder, name, size and mtime of every file, and of the shape and
+    dtype of the tensor; the key does not depend on where the dataset is mounted or staged
+    """
+    sha1 = hashlib.sha1('{}\t{}'.format(tuple(shape), np.dtype(dtype).str).encode())
+    for f_name in f_names:
+        stat = os.stat(f_name)
+        sha1.update('\n{}\t{}\t{}'.format('/'.join(f_name.split(os.sep)[-5:]), stat.st_size,
+                                         stat.st_mtime_ns).encode())
+    return sha1.hexdigest()
+
+
+def cached_tensor(f_names, shape, dtype, fill, name='tensor', cache=True, tensor_folder=None):
+    """
+    Returns the tensor built from f_names, from the cache when it was built before. A new tensor is filled in a
+    temporary memory mapped file, so that it never has to fit in memory, and renamed once complete.
+    :param f_names: paths to the files the tensor is built from, in the order of its rows
+    :param shape: shape of the tensor
+    :param dtype: dtype of the tensor
+    :param fill: function(X) writing the rows of the tensor X
+    :param name: prefix of the cache file, ex: the name of the data folder
+    :param cache: if False, the tensor is built in memory and not cached
+    :param tensor_folder: path to the cache folder, defaults to tensor_folder_path()
+    :return: the tensor, memory mapped copy-on-write when cached: in place changes stay in memory and never reach
+    the cache
+    """
+    if not cache or not len(f_names):
+        X = np.empty(shape, dtype=dtype)
+        fill(X)
+        return X
+
+    if tensor_folder is None:
+        tensor_folder = tensor_folder_path()
+    tensor_file = os.path.join(tensor_folder, '{}_{}.npy'.format(name, tensor_key(f_names, shape, dtype)[:20]))
+    if not os.path.isfile(tensor_file):
+        def write_tensor(tmp_file):
+            X = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=tuple(shape))
+            fill(X)
+            X.flush()
+
+        os.makedirs(tensor_folder, exist_ok=True)
+        atomic_write(tensor_file, write_tensor)
+    else:
+        print('Tensor of {} {} loaded from {}'.format(len(f_names), name, tensor_file))
+    return np.load(tensor_file, mmap_mode='c')
@@ -0,0 +1,125 @@
+# shared fixtures of the tests: a small synthetic So2Sat POP dataset (Part1 and Part2) with the folder layout, file
+# names and dtypes of the real one, and a fresh working folder for everything the pipeline writes to the current folder
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import rasterio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import covariate_list, osm_features  # noqa: E402
+
+# data folder -> (bands, dtype) of the patches of So2Sat POP Part1
+part1_modalities = {'lu': (4, 'float32'), 'lcz': (1, 'uint8'), 'viirs': (1, 'float32'),
+                    'sen2_rgb_autumn': (3, 'uint8'), 'sen2_rgb_spring': (3, 'uint8'),
+                    'sen2_rgb_summer': (3, 'uint8'), 'sen2_rgb_winter': (3, 'uint8')}
+osm_keys = covariate_list[-osm_features:]  # names of the osm features, the last covariates of the regressors
+# split -> list of (city name, number of patches)
+synthetic_cities = {'train': [('00001_00001_alpha', 7), ('00002_00002_beta', 5)],
+                    'test': [('00003_00003_gamma', 4)]}
+patch_size = 100
+
+
+def write_tif(file_path, array):
+    """
+    :param file_path: path to the patch
+    :param array: bands of the patch, shape (bands, rows, cols)
+    :return: None
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    bands, rows, cols = array.shape
+    with rasterio.open(file_path, 'w', driver='GTiff', height=rows, width=cols, count=bands,
+                       dtype=array.dtype) as ds:
+        ds.write(array)
+
+
+def random_patch(rng, data, bands, dtype):
+    """
+    :param rng: numpy random generator
+    :param data: name of the data folder
+    :param bands: number of bands
+    :param dtype: dtype of the patch
+    :return: random patch of the data folder, shape (bands, patch_size, patch_size)
+    """
+    if dtype == 'uint8':
+        return rng.integers(0, 17 if data == 'lcz' else 256, (bands, patch_size, patch_size)).astype(np.uint8)
+    return (rng.random((bands, patch_size, patch_size)) * 50).astype(np.float32)
+
+
+def make_so2sat(root, seed=0):
+    """
+    Writes a synthetic So2Sat POP Part1 (rasters, osm features and city csv) and Part2 (dem) to root
+    :param root: folder the two parts are written to
+    :param seed: seed of the patch values
+    :return: path to So2Sat_POP_Part1, path to So2Sat_POP_Part2
+    """
+    rng = np.random.default_rng(seed)
+    part1_path = os.path.join(root, 'So2Sat_POP_Part1')
+    part2_path = os.path.join(root, 'So2Sat_POP_Part2')
+    for split, cities in synthetic_cities.items():
+        for city, n_patches in cities:
+            grd_ids = ['1kmN{:04d}E{:04d}'.format(k, rng.integers(1000, 9999)) for k in range(n_patches)]
+            classes = rng.integers(0, 5, n_patches)
+            pops = rng.integers(0, 20000, n_patches)
+            for part_path in (part1_path, part2_path):
+                os.makedirs(os.path.join(part_path, split, city), exist_ok=True)
+                with open(os.path.join(part_path, split, city, city + '.csv'), 'w') as f:
+                    f.write('GRD_ID,POP,Class\n')
+                    f.writelines('{},{},{}\n'.format(*row) for row in zip(grd_ids, pops, classes))
+            for grd_id, class_id in zip(grd_ids, classes):
+                for data, (bands, dtype) in part1_modalities.items():
+                    write_tif(os.path.join(part1_path, split, city, data, 'Class_{}'.format(class_id),
+                                           '{}_{}.tif'.format(grd_id, data)), random_patch(rng, data, bands, dtype))
+                write_tif(os.path.join(part2_path, split, city, 'dem', 'Class_{}'.format(class_id),
+                                       '{}_dem.tif'.format(grd_id)), random_patch(rng, 'dem', 1, 'float32'))
+                osm_file = os.path.join(part1_path, split, city, 'osm_features', 'Class_{}'.format(class_id),
+                                        '{}_osm_features.csv'.format(grd_id))
+                os.makedirs(os.path.dirname(osm_file), exist_ok=True)
+                with open(osm_file, 'w') as f:
+                    f.writelines('{},{!r}\n'.format(key, float(value))
+                                 for key, value in zip(osm_keys, rng.random(osm_features)))
+    return part1_path, part2_path
+
+
+@pytest.fixture(scope='session')
+def so2sat_data(tmp_path_factory):
+    """
+    :return: paths to the synthetic So2Sat POP Part1 and Part2, shared by the tests that do not change them
+    """
+    return make_so2sat(str(tmp_path_factory.mktemp('so2sat')))
+
+
+@pytest.fixture
+def so2sat_copy(so2sat_data, tmp_path):
+    """
+    :return: paths to a copy of the synthetic So2Sat POP Part1 and Part2 the test can change
+    """
+    copies = []
+    for part_path in so2sat_data:
+        copy_path = os.path.join(str(tmp_path), 'data', os.path.basename(part_path))
+        shutil.copytree(part_path, copy_path)
+        copies.append(copy_path)
+    return tuple(copies)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    :return: path to an empty folder used as the current folder of the pipeline: the feature store, manifests,
+    journals, caches and logs are written there
+    """
+    folder = os.path.join(str(tmp_path), 'work')
+    os.makedirs(folder)
+    monkeypatch.chdir(folder)
+    for module in list(sys.modules.values()):
+        if isinstance(getattr(module, 'current_dir_path', None), str):
+            monkeypatch.setattr(module, 'current_dir_path', folder)
+    return folder
+
+
+def pytest_configure(config):
+    # the synthetic patches have no geotransform, the features do not use it
+    config.addinivalue_line('filterwarnings', 'ignore::rasterio.errors.NotGeoreferencedWarning')
@@ -0,0 +1,53 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from feature_store import feature_names, find_city_feature_file, load_features, read_schema
+from utils import append_features, feature_engineering, get_id_response_var_test
+
+
+def viirs_std(each_data, all_patches):
+    id_list, _ = get_id_response_var_test(all_patches)
+    values = []
+    for each_patch in all_patches:
+        with rasterio.open(each_patch) as ds:
+            values.append(np.std(ds.read(1)))
+    return pd.DataFrame({'VIIRS_STD': values}, index=pd.Index(id_list, name='GRD_ID'))
+
+
+def test_append_features_joins_on_grd_id(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    base_version = read_schema(feature_folder)['version']
+    before = {split: load_features(feature_folder, split) for split in ['train', 'test']}
+
+    append_features(part1_path, 'viirs', viirs_std, ['VIIRS_STD'], 'texture', feature_folder=feature_folder)
+
+    schema = read_schema(feature_folder)
+    assert schema['version'] == base_version + 1
+    assert feature_names(feature_folder, 'texture') == ['VIIRS_STD']
+    assert 'VIIRS_MEAN' in feature_names(feature_folder, 'base')
+    for split in ['train', 'test']:
+        df = load_features(feature_folder, split)
+        pd.testing.assert_frame_equal(df.drop(columns=['VIIRS_STD']), before[split])
+        for city, grd_id, value in zip(df['CITY'], df['GRD_ID'], df['VIIRS_STD']):
+            patch = glob.glob(os.path.join(part1_path, split, city, 'viirs', '*', grd_id + '_viirs.tif'))[0]
+            with rasterio.open(patch) as ds:
+                np.testing.assert_allclose(value, np.std(ds.read(1)), rtol=1e-6)
+
+
+def test_append_features_resumes(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    append_features(part1_path, 'viirs', viirs_std, ['VIIRS_STD'], 'texture', feature_folder=feature_folder)
+    city_files = [find_city_feature_file(city_folder)
+                  for city_folder in glob.glob(os.path.join(feature_folder, '*', '*'))]
+    mtimes = [os.stat(city_file).st_mtime_ns for city_file in city_files]
+    version = read_schema(feature_folder)['version']
+
+    append_features(part1_path, 'viirs', viirs_std, ['VIIRS_STD'], 'texture', feature_folder=feature_folder)
+    assert [os.stat(city_file).st_mtime_ns for city_file in city_files] == mtimes
+    assert read_schema(feature_folder)['version'] == version
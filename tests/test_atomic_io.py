@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+from atomic_io import atomic_write, atomic_write_json
+
+
+def test_atomic_write_replaces_the_file(tmp_path):
+    file_path = str(tmp_path / 'data.json')
+    atomic_write_json(file_path, {'a': 1})
+    atomic_write_json(file_path, {'a': 2})
+    with open(file_path) as f:
+        assert f.read() == '{"a": 2}'
+    assert os.listdir(str(tmp_path)) == ['data.json']
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    file_path = str(tmp_path / 'data.bin')
+    atomic_write(file_path, lambda tmp_file: open(tmp_file, 'wb').close())
+
+    def failing_writer(tmp_file):
+        with open(tmp_file, 'wb') as f:
+            f.write(b'partial')
+        raise RuntimeError('disk full')
+
+    with pytest.raises(RuntimeError):
+        atomic_write(file_path, failing_writer)
+    assert os.listdir(str(tmp_path)) == ['data.bin']
+    assert os.path.getsize(file_path) == 0
@@ -0,0 +1,64 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from constants import osm_features
+from manifest import build_manifest
+from utils import batch_index, iterate_batches
+
+from conftest import synthetic_cities
+
+modalities = ['sen2_rgb_autumn', 'lu', 'viirs', 'dem', 'osm_features']
+
+
+def train_index(part1_path, part2_path, with_manifest):
+    if with_manifest:
+        return batch_index(os.path.join(part1_path, 'train'), modalities, manifest=build_manifest(part1_path),
+                           part2_folder_path=os.path.join(part2_path, 'train'),
+                           manifest_part2=build_manifest(part2_path))
+    return batch_index(os.path.join(part1_path, 'train'), modalities,
+                       part2_folder_path=os.path.join(part2_path, 'train'))
+
+
+@pytest.mark.parametrize('with_manifest', [False, True])
+def test_batch_shapes(so2sat_data, workdir, with_manifest):
+    index = train_index(*so2sat_data, with_manifest)
+    assert len(index) == sum(n_patches for _, n_patches in synthetic_cities['train'])
+    assert all(os.path.isfile(each_patch) for data in modalities for each_patch in index[data])
+
+    batches = list(iterate_batches(index, modalities, batch_size=5, shuffle=False))
+    assert [len(batch['GRD_ID']) for batch in batches] == [5, 5, 2]
+    for batch in batches:
+        n = len(batch['GRD_ID'])
+        assert batch['sen2_rgb_autumn'].shape == (n, 100, 100, 3) and batch['sen2_rgb_autumn'].dtype == np.uint8
+        assert batch['lu'].shape == (n, 100, 100, 4) and batch['lu'].dtype == np.float32
+        assert batch['viirs'].shape == (n, 100, 100, 1) and batch['dem'].shape == (n, 100, 100, 1)
+        assert batch['osm_features'].shape == (n, osm_features) and batch['osm_features'].dtype == np.float32
+        assert batch['POP'].shape == (n,) and batch['CLASS'].shape == (n,)
+    assert np.concatenate([batch['GRD_ID'] for batch in batches]).tolist() == index['GRD_ID'].tolist()
+
+
+def test_seeded_shuffling_of_the_manifest_index(so2sat_data, workdir):
+    index = train_index(*so2sat_data, with_manifest=True)
+
+    def grd_ids(seed):
+        return [batch['GRD_ID'].tolist() for batch in iterate_batches(index, ['viirs'], batch_size=4, seed=seed)]
+
+    assert grd_ids(3) == grd_ids(3)
+    assert grd_ids(3) != grd_ids(4)
+    shuffled = sum(grd_ids(3), [])
+    assert shuffled != index['GRD_ID'].tolist() and sorted(shuffled) == sorted(index['GRD_ID'])
+
+    # every patch stays aligned with its own row of the index
+    for batch in iterate_batches(index, ['viirs'], batch_size=4, seed=3):
+        rows = index.set_index('GRD_ID').loc[batch['GRD_ID']]
+        np.testing.assert_array_equal(batch['POP'], rows['POP'].to_numpy())
+
+
+def test_csv_row_without_patch(so2sat_copy, workdir):
+    part1_path, part2_path = so2sat_copy
+    os.remove(sorted(glob.glob(os.path.join(part1_path, 'train', '*', 'lu', '*', '*')))[0])
+    with pytest.raises(ValueError, match='no lu patch'):
+        train_index(part1_path, part2_path, with_manifest=True)
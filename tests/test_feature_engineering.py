@@ -0,0 +1,150 @@
+import glob
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pandas as pd
+import rasterio
+
+from feature_store import load_features, read_city_features
+from manifest import build_manifest
+from utils import feature_engineering, sen2_columns, sen2_seasons
+
+from conftest import osm_keys, random_patch, write_tif
+
+
+def find_patch(part_path, split, city, data, grd_id):
+    return glob.glob(os.path.join(part_path, split, city, data, '*', '{}_*'.format(grd_id)))
+
+
+def read_bands(file_path):
+    with rasterio.open(file_path) as ds:
+        return ds.read()
+
+
+def reference_features(part1_path, part2_path, split, city, grd_id):
+    """
+    :return: features of one patch computed from its own files, as the per patch loops of the baseline did
+    """
+    features = {}
+    lu = read_bands(find_patch(part1_path, split, city, 'lu', grd_id)[0])
+    for band in range(4):
+        features['LU_{}_A'.format(band + 1)] = np.sum(lu[band])
+    lcz = read_bands(find_patch(part1_path, split, city, 'lcz', grd_id)[0])[0]
+    features['LCZ_CL'] = np.argmax(np.bincount(lcz.flatten()))
+    viirs = read_bands(find_patch(part1_path, split, city, 'viirs', grd_id)[0])[0]
+    features['VIIRS_MEAN'], features['VIIRS_MAX'] = np.mean(viirs), np.max(viirs)
+    for folder, season in sen2_seasons.items():
+        sen2 = cv2.imread(find_patch(part1_path, split, city, 'sen2_rgb_' + folder, grd_id)[0])
+        statistics = [(np.mean(band), np.median(band), np.std(band), np.max(band), np.min(band))
+                      for band in (sen2[:, :, 0], sen2[:, :, 1], sen2[:, :, 2])]
+        for column, value in zip(sen2_columns(season), [statistics[k][s] for s in range(5) for k in range(3)]):
+            features[column] = value
+    osm_file = find_patch(part1_path, split, city, 'osm_features', grd_id)[0]
+    osm_values = pd.read_csv(osm_file, header=None, index_col=0)[1]
+    for key in osm_keys:
+        features[key] = osm_values[key]
+    dem_patches = find_patch(part2_path, split, city, 'dem', grd_id)
+    if dem_patches:
+        dem = read_bands(dem_patches[0])[0]
+        features['DEM_MEAN'], features['DEM_MAX'] = np.mean(dem), np.max(dem)
+    else:
+        features['DEM_MEAN'] = features['DEM_MAX'] = np.nan
+    if split == 'train':
+        city_df = pd.read_csv(os.path.join(part1_path, split, city, city + '.csv')).set_index('GRD_ID')
+        features['POP'] = city_df.loc[grd_id, 'POP']
+    return features
+
+
+def check_against_reference(feature_folder, part1_path, part2_path):
+    for split in ['train', 'test']:
+        df = load_features(feature_folder, split)
+        cities = sorted(os.listdir(os.path.join(part1_path, split)))
+        assert sorted(df['CITY'].unique()) == cities
+        for city in cities:
+            city_ids = sorted(os.path.basename(path).split('_')[0]
+                              for path in glob.glob(os.path.join(part1_path, split, city, 'osm_features', '*', '*')))
+            assert sorted(df.loc[df['CITY'] == city, 'GRD_ID']) == city_ids
+        for _, row in df.iterrows():
+            for column, value in reference_features(part1_path, part2_path, split, row['CITY'], row['GRD_ID']).items():
+                np.testing.assert_allclose(row[column], value, rtol=1e-6, err_msg='{} of {}'.format(
+                    column, row['GRD_ID']))
+
+
+def test_features_match_per_patch_reference(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    check_against_reference(feature_folder, part1_path, part2_path)
+
+
+def test_join_on_grd_id_with_extra_and_missing_patches(so2sat_copy, workdir):
+    part1_path, part2_path = so2sat_copy
+    city_folder = sorted(glob.glob(os.path.join(part1_path, 'train', '*')))[0]
+    city = os.path.basename(city_folder)
+    # lu patch without osm_features and csv row: dropped by the join
+    write_tif(os.path.join(city_folder, 'lu', 'Class_0', '1kmN9999E9999_lu.tif'),
+              random_patch(np.random.default_rng(1), 'lu', 4, 'float32'))
+    # dem patch missing: the dem features of its row are left empty
+    missing_dem = sorted(glob.glob(os.path.join(part2_path, 'train', city, 'dem', '*', '*')))[0]
+    os.remove(missing_dem)
+
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    df = load_features(feature_folder, 'train')
+    assert '1kmN9999E9999' not in set(df['GRD_ID'])
+    missing_id = os.path.basename(missing_dem).split('_')[0]
+    assert df.loc[df['GRD_ID'] == missing_id, 'DEM_MEAN'].isna().all()
+    check_against_reference(feature_folder, part1_path, part2_path)
+
+
+def test_pool_and_serial_runs_write_the_same_features(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    city_folders = sorted(glob.glob(os.path.join(feature_folder, '*', '*')))
+    serial = {city_folder: read_city_features(city_folder) for city_folder in city_folders}
+
+    feature_engineering(part1_path, n_workers=2, part2_path=part2_path, resume=False)
+    assert sorted(glob.glob(os.path.join(feature_folder, '*', '*'))) == city_folders
+    for city_folder in city_folders:
+        pd.testing.assert_frame_equal(read_city_features(city_folder), serial[city_folder])
+
+
+def test_city_without_part2_patches(so2sat_copy, workdir):
+    part1_path, part2_path = so2sat_copy
+    city_folder = sorted(glob.glob(os.path.join(part2_path, 'train', '*')))[-1]
+    shutil.rmtree(os.path.join(city_folder, 'dem'))
+
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    df = load_features(feature_folder, 'train', columns=['CITY', 'GRD_ID', 'DEM_MEAN', 'DEM_MAX'])
+    without_dem = df['CITY'] == os.path.basename(city_folder)
+    assert without_dem.any() and df.loc[without_dem, ['DEM_MEAN', 'DEM_MAX']].isna().all().all()
+    assert df.loc[~without_dem, ['DEM_MEAN', 'DEM_MAX']].notna().all().all()
+    check_against_reference(feature_folder, part1_path, part2_path)
+
+
+def test_covariate_run_keeps_the_full_feature_store(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    full = {split: load_features(feature_folder, split) for split in ['train', 'test']}
+    covariates = ['LU_2_A', 'SEN2_SUM_MED_G', 'SEN2_WIN_STD_R', 'highway', 'DEM_MAX']
+
+    covariate_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path, covariates=covariates,
+                                           splits=['test'])
+    assert covariate_folder != feature_folder
+    assert os.path.basename(covariate_folder).startswith('So2Sat_POP_features_covariates_')
+    for split in ['train', 'test']:
+        pd.testing.assert_frame_equal(load_features(feature_folder, split), full[split])
+    pruned = load_features(covariate_folder, 'test')
+    assert list(pruned.columns) == ['CITY', 'GRD_ID', 'LU_2_A', 'SEN2_SUM_MED_G', 'SEN2_WIN_STD_R', 'highway',
+                                    'DEM_MAX']
+    pd.testing.assert_frame_equal(pruned, full['test'][pruned.columns])
+    assert load_features(covariate_folder, 'train').empty
+
+
+def test_part1_manifest_without_part2_manifest(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, manifest=build_manifest(part1_path),
+                                         part2_path=part2_path)
+    df = load_features(feature_folder, 'train')
+    assert df[['DEM_MEAN', 'DEM_MAX']].notna().all().all()
+    check_against_reference(feature_folder, part1_path, part2_path)
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_store
+from feature_store import (city_feature_file, city_feature_columns, load_feature_arrays, load_features,
+                           read_city_features, register_features, write_city_features)
+
+
+def city_frame(city, n_rows, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'CITY': city, 'GRD_ID': ['{}_{}'.format(city, k) for k in range(n_rows)],
+                         'POP': rng.integers(0, 1000, n_rows).astype(np.int64),
+                         'LU_1_A': rng.random(n_rows), 'VIIRS_MEAN': rng.random(n_rows).astype(np.float32)})
+
+
+@pytest.fixture
+def feature_folder(tmp_path):
+    folder = str(tmp_path / 'So2Sat_POP_features')
+    for split, cities in (('train', ['alpha', 'beta']), ('test', ['gamma'])):
+        for k, city in enumerate(cities):
+            feature_folder_city = os.path.join(folder, split, city)
+            os.makedirs(feature_folder_city)
+            df = city_frame(city, 5 + k, seed=k)
+            if split == 'test':
+                df = df.drop(columns=['POP'])
+            write_city_features(df, feature_folder_city)
+    return folder
+
+
+def test_city_features_round_trip(tmp_path):
+    feature_folder_city = str(tmp_path / 'train' / 'alpha')
+    os.makedirs(feature_folder_city)
+    df = city_frame('alpha', 6, seed=0)
+    feature_file = write_city_features(df, feature_folder_city)
+    assert feature_file == city_feature_file(feature_folder_city)
+    assert not os.path.exists(feature_file + '.tmp')
+    pd.testing.assert_frame_equal(read_city_features(feature_folder_city), df)
+    pd.testing.assert_frame_equal(read_city_features(feature_folder_city, ['GRD_ID', 'LU_1_A']),
+                                  df[['GRD_ID', 'LU_1_A']])
+    assert list(city_feature_columns(feature_file)) == list(df.columns)
+
+
+def test_load_features_projects_columns_and_filters_cities(feature_folder):
+    df = load_features(feature_folder, 'train', columns=['CITY', 'GRD_ID', 'LU_1_A'])
+    assert list(df.columns) == ['CITY', 'GRD_ID', 'LU_1_A']
+    assert sorted(df['CITY'].unique()) == ['alpha', 'beta']
+    assert len(df) == 5 + 6
+    expected = pd.concat([city_frame('alpha', 5, 0), city_frame('beta', 6, 1)], ignore_index=True)
+    merged = expected.merge(df, on=['CITY', 'GRD_ID'], suffixes=('', '_store'))
+    np.testing.assert_array_equal(merged['LU_1_A'], merged['LU_1_A_store'])
+
+    beta = load_features(feature_folder, 'train', cities=['beta'])
+    pd.testing.assert_frame_equal(beta, city_frame('beta', 6, 1))
+
+
+def test_load_features_checks_the_schema(feature_folder):
+    register_features(feature_folder, city_feature_columns(city_feature_file(os.path.join(feature_folder, 'train',
+                                                                                          'alpha'))), 'base')
+    assert len(load_features(feature_folder, 'train', columns=['GRD_ID', 'VIIRS_MEAN'])) == 11
+    with pytest.raises(KeyError):
+        load_features(feature_folder, 'train', columns=['GRD_ID', 'NOT_A_FEATURE'])
+
+
+def test_load_feature_arrays(feature_folder):
+    x, y, ids = load_feature_arrays(feature_folder, 'train', ['VIIRS_MEAN', 'LU_1_A'], target='POP')
+    df = load_features(feature_folder, 'train')
+    assert x.dtype == np.float32 and x.flags['C_CONTIGUOUS'] and x.shape == (11, 2)
+    assert y.dtype == np.float32
+    np.testing.assert_array_equal(x[:, 0], df['VIIRS_MEAN'].to_numpy(np.float32))
+    np.testing.assert_array_equal(x[:, 1], df['LU_1_A'].to_numpy(np.float32))
+    np.testing.assert_array_equal(y, df['POP'].to_numpy(np.float32))
+    assert list(ids.columns) == ['CITY', 'GRD_ID'] and ids['GRD_ID'].tolist() == df['GRD_ID'].tolist()
+
+    x_test, y_test, _ = load_feature_arrays(feature_folder, 'test', ['VIIRS_MEAN', 'LU_1_A'])
+    assert y_test is None and x_test.shape == (5, 2)
+
+
+def test_load_feature_arrays_fills_missing_values(feature_folder):
+    feature_folder_city = os.path.join(feature_folder, 'train', 'alpha')
+    df = read_city_features(feature_folder_city)
+    df.loc[2, 'LU_1_A'] = np.nan
+    write_city_features(df, feature_folder_city)
+    x, _, ids = load_feature_arrays(feature_folder, 'train', ['LU_1_A'], cities=['alpha'])
+    assert np.isnan(x[ids['GRD_ID'] == 'alpha_2', 0]).all()
+    x, _, ids = load_feature_arrays(feature_folder, 'train', ['LU_1_A'], cities=['alpha'], fill_value=0)
+    assert (x[ids['GRD_ID'] == 'alpha_2', 0] == 0).all()
+
+
+@pytest.mark.parametrize('store', ['arrow', 'pickle'])
+def test_load_features_of_cities_with_different_columns(tmp_path, monkeypatch, store):
+    if store == 'pickle':
+        monkeypatch.setattr(feature_store, 'pa', None)
+        monkeypatch.setattr(feature_store, 'feature_file_suffix', '_features.pkl')
+    folder = str(tmp_path / 'So2Sat_POP_features')
+    alpha = city_frame('alpha', 5, seed=0)
+    alpha['LCZ_CL'] = np.arange(5, dtype=np.int64)
+    # beta has no VIIRS_MEAN column (ex: no viirs patches) and a missing LCZ_CL value, stored as double
+    beta = city_frame('beta', 6, seed=1).drop(columns=['VIIRS_MEAN'])
+    beta['LCZ_CL'] = [1, 2, np.nan, 4, 5, 6]
+    for df in [alpha, beta]:
+        feature_folder_city = os.path.join(folder, 'train', df['CITY'].iloc[0])
+        os.makedirs(feature_folder_city)
+        feature_file = write_city_features(df, feature_folder_city)
+        assert feature_file.endswith({'arrow': '_features.arrow', 'pickle': '_features.pkl'}[store])
+
+    df = load_features(folder, 'train', columns=['CITY', 'GRD_ID', 'VIIRS_MEAN', 'LCZ_CL'])
+    assert list(df.columns) == ['CITY', 'GRD_ID', 'VIIRS_MEAN', 'LCZ_CL'] and len(df) == 11
+    df = df.set_index('GRD_ID')
+    assert df.loc[beta['GRD_ID'], 'VIIRS_MEAN'].isna().all()
+    np.testing.assert_allclose(df.loc[alpha['GRD_ID'], 'VIIRS_MEAN'], alpha['VIIRS_MEAN'], rtol=1e-6)
+    np.testing.assert_array_equal(df.loc[alpha['GRD_ID'], 'LCZ_CL'], alpha['LCZ_CL'])
+    np.testing.assert_array_equal(df.loc[beta['GRD_ID'], 'LCZ_CL'], beta['LCZ_CL'])
+    assert set(load_features(folder, 'train').columns) == set(alpha.columns)
+
+    x, _, ids = load_feature_arrays(folder, 'train', ['VIIRS_MEAN', 'LCZ_CL'], fill_value=0)
+    assert (x[ids['CITY'] == 'beta', 0] == 0).all()
+
+
+def test_load_features_of_a_column_no_city_has(feature_folder):
+    df = load_features(feature_folder, 'test', columns=['GRD_ID', 'POP', 'LU_1_A'])
+    assert list(df.columns) == ['GRD_ID', 'POP', 'LU_1_A'] and len(df) == 5
+    assert df['POP'].isna().all() and df['LU_1_A'].notna().all()
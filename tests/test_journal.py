@@ -0,0 +1,80 @@
+import glob
+import os
+import time
+
+import numpy as np
+import rasterio
+
+import journal
+from feature_store import find_city_feature_file, read_city_features
+from journal import city_fingerprints, journal_file_path
+from manifest import build_manifest, manifest_city_patches
+from utils import feature_engineering
+
+from conftest import random_patch, write_tif
+
+
+def feature_file_mtimes(feature_folder):
+    return {city_folder: os.stat(find_city_feature_file(city_folder)).st_mtime_ns
+            for city_folder in glob.glob(os.path.join(feature_folder, '*', '*'))}
+
+
+def test_resume_skips_unchanged_cities(so2sat_copy, workdir):
+    part1_path, part2_path = so2sat_copy
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    mtimes = feature_file_mtimes(feature_folder)
+    assert all(os.path.isfile(journal_file_path(city_folder)) for city_folder in mtimes)
+
+    feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    assert feature_file_mtimes(feature_folder) == mtimes
+
+    # new values in one viirs patch: only its city is computed again, with the new values
+    changed_patch = sorted(glob.glob(os.path.join(part1_path, 'train', '*', 'viirs', '*', '*')))[0]
+    changed_city = os.path.join(feature_folder, 'train', changed_patch.split(os.sep)[-4])
+    time.sleep(0.01)
+    write_tif(changed_patch, random_patch(np.random.default_rng(7), 'viirs', 1, 'float32'))
+
+    feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    new_mtimes = feature_file_mtimes(feature_folder)
+    assert [city_folder for city_folder in mtimes if new_mtimes[city_folder] != mtimes[city_folder]] == [changed_city]
+    df = read_city_features(changed_city).set_index('GRD_ID')
+    with rasterio.open(changed_patch) as ds:
+        viirs = ds.read(1)
+    np.testing.assert_allclose(df.loc[os.path.basename(changed_patch).split('_')[0], 'VIIRS_MEAN'], np.mean(viirs),
+                               rtol=1e-6)
+
+
+def test_no_resume_computes_every_city(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    mtimes = feature_file_mtimes(feature_folder)
+    time.sleep(0.01)
+    feature_engineering(part1_path, n_workers=1, part2_path=part2_path, resume=False)
+    new_mtimes = feature_file_mtimes(feature_folder)
+    assert all(new_mtimes[city_folder] != mtimes[city_folder] for city_folder in mtimes)
+
+
+def test_manifest_fingerprints_equal_stat_fingerprints(so2sat_data, workdir, monkeypatch):
+    part1_path, _ = so2sat_data
+    manifest = build_manifest(part1_path)
+    all_city_patches = manifest_city_patches(manifest, part1_path)
+    from_stat = {each_city: city_fingerprints(city_patches) for each_city, city_patches in all_city_patches.items()}
+
+    def no_stat(*args, **kwargs):
+        raise AssertionError('os.stat called on a patch of the manifest')
+
+    monkeypatch.setattr(journal.os, 'stat', no_stat)
+    from_manifest = {each_city: city_fingerprints(city_patches, manifest)
+                     for each_city, city_patches in all_city_patches.items()}
+    assert from_manifest == from_stat
+
+
+def test_resume_with_manifest_skips_unchanged_cities(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    manifest, manifest_part2 = build_manifest(part1_path), build_manifest(part2_path)
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    mtimes = feature_file_mtimes(feature_folder)
+    # the journal written from os.stat matches the fingerprints taken from the manifests
+    feature_engineering(part1_path, n_workers=1, manifest=manifest, part2_path=part2_path,
+                        manifest_part2=manifest_part2)
+    assert feature_file_mtimes(feature_folder) == mtimes
@@ -0,0 +1,57 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+from manifest import build_manifest, manifest_cities, manifest_city_patches, manifest_file_path
+from utils import get_all_cities, list_city_patches
+
+from conftest import write_tif, random_patch
+
+
+def listed_patches(part_path):
+    return sorted(glob.glob(os.path.join(part_path, '*', '*', '*', '*', '*')))
+
+
+def test_manifest_lists_every_patch(so2sat_data, workdir):
+    part1_path, _ = so2sat_data
+    manifest = build_manifest(part1_path)
+    assert sorted(manifest['PATH']) == listed_patches(part1_path)
+    assert os.path.isfile(manifest_file_path(part1_path))
+    for path, grd_id, size in zip(manifest['PATH'], manifest['GRD_ID'], manifest['SIZE']):
+        assert os.path.basename(path).startswith(grd_id + '_')
+        assert os.path.getsize(path) == size
+
+
+def test_manifest_city_patches_match_file_system(so2sat_data, workdir):
+    part1_path, _ = so2sat_data
+    manifest = build_manifest(part1_path)
+    all_cities, _ = get_all_cities(part1_path)
+    assert sorted(manifest_cities(manifest, part1_path)) == sorted(all_cities)
+    all_city_patches = manifest_city_patches(manifest, part1_path)
+    for each_city in all_cities:
+        city_patches = list_city_patches(each_city)
+        assert sorted(all_city_patches[each_city]) == sorted(city_patches)
+        for each_data, all_patches in city_patches.items():
+            assert sorted(all_city_patches[each_city][each_data]) == sorted(all_patches)
+
+
+def test_manifest_refresh_lists_changed_folders_only(so2sat_copy, workdir, capsys):
+    part1_path, _ = so2sat_copy
+    build_manifest(part1_path)
+    reused = build_manifest(part1_path)
+    assert sorted(reused['PATH']) == listed_patches(part1_path)
+
+    # a new patch in an existing class folder changes the mtime of that folder only
+    class_folder = sorted(glob.glob(os.path.join(part1_path, 'train', '*', 'lu', 'Class_*')))[0]
+    time.sleep(0.01)
+    new_patch = os.path.join(class_folder, '1kmN9999E9999_lu.tif')
+    write_tif(new_patch, random_patch(np.random.default_rng(1), 'lu', 4, 'float32'))
+
+    assert new_patch not in set(build_manifest(part1_path, refresh=False)['PATH'])
+    capsys.readouterr()
+    refreshed = build_manifest(part1_path)
+    assert ' 1 class folders listed' in capsys.readouterr().out
+    assert new_patch in set(refreshed['PATH'])
+    assert sorted(refreshed['PATH']) == listed_patches(part1_path)
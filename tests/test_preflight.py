@@ -0,0 +1,56 @@
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import part1_modalities, synthetic_cities
+from preflight import preflight, preflight_report_path
+
+n_patches = sum(n for cities in synthetic_cities.values() for _, n in cities)
+
+
+def test_report_of_a_clean_tree(so2sat_data, workdir):
+    report = preflight(*so2sat_data)
+    assert report['ok'] and report['n_errors'] == 0 and report['n_warnings'] == 0 and report['issues'] == []
+    assert report['n_cities'] == 3
+    assert report['n_patches'] == n_patches * (len(part1_modalities) + 2)  # Part1, osm_features and dem
+    assert report['n_headers'] == n_patches * (len(part1_modalities) + 1)
+    with open(preflight_report_path()) as f:
+        assert json.load(f) == report
+
+
+def test_report_of_the_issues(so2sat_copy, workdir):
+    part1_path, part2_path = so2sat_copy
+    lu_patches = sorted(glob.glob(os.path.join(part1_path, 'train', '*', 'lu', '*', '*')))
+    os.remove(lu_patches[0])
+    viirs_patch = sorted(glob.glob(os.path.join(part1_path, 'test', '*', 'viirs', '*', '*')))[0]
+    open(viirs_patch, 'w').close()
+    # hidden folders are not cities
+    os.makedirs(os.path.join(part1_path, 'train', '.snapshot', 'lu'))
+    os.makedirs(os.path.join(part2_path, '.snapshot', 'train', '00001_00001_alpha'))
+
+    report = preflight(part1_path, part2_path)
+    issues = {(issue['check'], issue['modality']): issue for issue in report['issues']}
+    assert set(issues) == {('missing_patches', 'lu'), ('empty_files', 'viirs'), ('unreadable_rasters', 'viirs')}
+    assert issues[('missing_patches', 'lu')]['severity'] == 'warning'
+    assert issues[('missing_patches', 'lu')]['examples'] == [os.path.basename(lu_patches[0]).split('_')[0]]
+    assert issues[('empty_files', 'viirs')]['examples'] == [viirs_patch]
+    assert not report['ok'] and report['n_errors'] == 2 and report['n_warnings'] == 1
+    assert report['n_cities'] == 3
+
+
+def test_city_mismatch_exits_with_an_error(so2sat_copy, workdir):
+    part1_path, part2_path = so2sat_copy
+    shutil.rmtree(os.path.join(part2_path, 'test', synthetic_cities['test'][0][0]))
+    report_file = os.path.join(workdir, 'report.json')
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'preflight.py')
+    result = subprocess.run([sys.executable, script, '--data_path_So2Sat_pop_part1', part1_path,
+                             '--data_path_So2Sat_pop_part2', part2_path, '--headers', '0', '--report', report_file],
+                            cwd=workdir, capture_output=True, text=True)
+    assert result.returncode == 1, result.stderr
+    with open(report_file) as f:
+        report = json.load(f)
+    assert [(issue['check'], issue['split'], issue['city'], issue['detail']) for issue in report['issues']] == [
+        ('city_mismatch', 'test', synthetic_cities['test'][0][0], 'city missing from Part2')]
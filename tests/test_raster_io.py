@@ -0,0 +1,63 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+import raster_io
+from raster_io import raster_reader, read_raster, set_raster_backend
+
+from conftest import write_tif
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    # backends picked by the test only
+    monkeypatch.setattr(raster_io, 'modality_backends', {})
+    return raster_io.modality_backends
+
+
+def read_bands(file_path):
+    with rasterio.open(file_path) as ds:
+        return ds.read()
+
+
+def test_backends_read_the_patches_as_rasterio(so2sat_data, backends):
+    for data in ['lu', 'lcz', 'viirs', 'sen2_rgb_spring']:
+        all_patches = sorted(glob.glob(os.path.join(so2sat_data[0], 'train', '*', data, '*', '*')))
+        reader = raster_reader(all_patches)
+        assert data in backends
+        for each_patch in all_patches:
+            expected = read_bands(each_patch)
+            array = reader(each_patch)
+            assert array.dtype == expected.dtype
+            np.testing.assert_array_equal(array, expected)
+
+
+def test_patch_the_backend_can_not_decode(so2sat_copy, backends, capsys):
+    all_patches = sorted(glob.glob(os.path.join(so2sat_copy[0], 'train', '*', 'viirs', '*', '*')))
+    reader = raster_reader(all_patches)
+    set_raster_backend('viirs', 'cv2')
+    # 2 float32 bands, a layout OpenCV does not decode
+    odd_patch = all_patches[0]
+    write_tif(odd_patch, np.arange(2 * 100 * 100, dtype=np.float32).reshape(2, 100, 100))
+    capsys.readouterr()
+
+    np.testing.assert_array_equal(reader(odd_patch), read_bands(odd_patch))
+    assert 'cv2 can not decode' in capsys.readouterr().out
+    assert backends['viirs'] == raster_io.raster_backend_names[0]
+    for each_patch in all_patches[1:]:
+        np.testing.assert_array_equal(read_raster(each_patch), read_bands(each_patch))
+
+
+def test_read_raster_picks_the_backend_on_the_sample(so2sat_data, backends, monkeypatch):
+    all_patches = sorted(glob.glob(os.path.join(so2sat_data[0], 'train', '*', 'lcz', '*', '*')))
+    samples = []
+    benchmark = raster_io.benchmark_raster_backends
+    monkeypatch.setattr(raster_io, 'benchmark_raster_backends',
+                        lambda sample_patches: samples.append(list(sample_patches)) or benchmark(sample_patches))
+    np.testing.assert_array_equal(read_raster(all_patches[0], sample_patches=all_patches), read_bands(all_patches[0]))
+    assert samples == [all_patches]
+    read_raster(all_patches[1])
+    assert len(samples) == 1  # picked once per modality
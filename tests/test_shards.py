@@ -0,0 +1,50 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_store import read_city_features
+from utils import feature_engineering, get_fnames_labels, pack_shards
+
+
+@pytest.fixture
+def shard_folder(so2sat_data, workdir):
+    part1_path, part2_path = so2sat_data
+    folder = os.path.join(workdir, 'So2Sat_POP_shards')
+    pack_shards(part1_path, folder)
+    pack_shards(part2_path, folder)
+    return folder
+
+
+def test_shard_features_match_patch_features(so2sat_data, shard_folder):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    city_folders = sorted(glob.glob(os.path.join(feature_folder, '*', '*')))
+    from_patches = {city_folder: read_city_features(city_folder) for city_folder in city_folders}
+
+    assert feature_engineering(shard_folder, n_workers=1, resume=False, shards=True) == feature_folder
+    for city_folder in city_folders:
+        pd.testing.assert_frame_equal(read_city_features(city_folder), from_patches[city_folder])
+
+
+@pytest.mark.parametrize('data', ['lu', 'lcz', 'sen2_rgb_summer', 'osm_features', 'dem'])
+def test_shard_tensors_match_patch_tensors(so2sat_data, shard_folder, data):
+    part1_path, part2_path = so2sat_data
+    part_path = part2_path if data == 'dem' else part1_path
+    x, pop, classes = get_fnames_labels(os.path.join(part_path, 'train'), data, cache=False)
+    x_shards, pop_shards, classes_shards = get_fnames_labels(os.path.join(shard_folder, 'train'), data, shards=True)
+    assert x_shards.dtype == x.dtype
+    np.testing.assert_array_equal(x_shards, x)
+    np.testing.assert_array_equal(pop_shards, pop)
+    np.testing.assert_array_equal(classes_shards, classes)
+
+
+def test_packing_again_skips_unchanged_data_folders(so2sat_data, shard_folder):
+    part1_path, _ = so2sat_data
+    chunk_files = sorted(glob.glob(os.path.join(shard_folder, '*', '*', '*', '*')))
+    assert chunk_files
+    mtimes = [os.stat(chunk_file).st_mtime_ns for chunk_file in chunk_files]
+    pack_shards(part1_path, shard_folder)
+    assert [os.stat(chunk_file).st_mtime_ns for chunk_file in chunk_files] == mtimes
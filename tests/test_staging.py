@@ -0,0 +1,63 @@
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+import staging
+from feature_store import load_features
+from manifest import build_manifest
+from staging import stage_dataset, staged_manifest
+from utils import feature_engineering
+
+
+def relative_files(part_path):
+    return sorted(os.path.relpath(path, part_path)
+                  for path in glob.glob(os.path.join(part_path, '**', '*'), recursive=True) if os.path.isfile(path))
+
+
+@pytest.mark.parametrize('with_manifest', [False, True])
+def test_stage_dataset_copies_once(so2sat_data, workdir, tmp_path, capsys, with_manifest):
+    part1_path, _ = so2sat_data
+    manifest = build_manifest(part1_path) if with_manifest else None
+    stage_dir = str(tmp_path / 'stage')
+    staged_path = stage_dataset(part1_path, stage_dir, manifest=manifest)
+    assert staged_path == os.path.join(stage_dir, 'So2Sat_POP_Part1')
+    assert relative_files(staged_path) == relative_files(part1_path)
+
+    capsys.readouterr()
+    stage_dataset(part1_path, stage_dir, manifest=manifest)
+    assert ': 0 files copied' in capsys.readouterr().out
+
+
+def test_stage_dataset_checks_the_free_space(so2sat_data, tmp_path, monkeypatch):
+    stage_dir = str(tmp_path / 'stage')
+    monkeypatch.setattr(staging.shutil, 'disk_usage', lambda path: staging.shutil._ntuple_diskusage(1, 1, 1))
+    with pytest.raises(IOError):
+        stage_dataset(so2sat_data[0], stage_dir)
+    assert relative_files(stage_dir) == []
+
+
+def test_features_of_a_partial_staging(so2sat_data, workdir, tmp_path):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    expected = {split: load_features(feature_folder, split) for split in ['train', 'test']}
+
+    # lu and osm_features of Part1 only, the sen2, lcz, viirs and dem patches are read from their location
+    modalities = ['lu', 'osm_features']
+    stage_dir = str(tmp_path / 'stage')
+    manifests = []
+    for part_path in (part1_path, part2_path):
+        manifest = build_manifest(part_path)
+        staged_path = stage_dataset(part_path, stage_dir, modalities=modalities, manifest=manifest)
+        manifests.append((staged_path, staged_manifest(manifest, part_path, staged_path, modalities=modalities)))
+    (staged_part1, manifest_part1), (staged_part2, manifest_part2) = manifests
+    staged_rows = manifest_part1['MODALITY'].isin(modalities)
+    assert manifest_part1.loc[staged_rows, 'PATH'].str.startswith(staged_part1).all()
+    assert manifest_part1.loc[~staged_rows, 'PATH'].str.startswith(part1_path).all()
+    assert manifest_part2['PATH'].str.startswith(part2_path).all()
+
+    feature_engineering(staged_part1, n_workers=1, manifest=manifest_part1, part2_path=staged_part2,
+                        manifest_part2=manifest_part2, resume=False)
+    for split in ['train', 'test']:
+        pd.testing.assert_frame_equal(load_features(feature_folder, split), expected[split])
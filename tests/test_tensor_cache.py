@@ -0,0 +1,48 @@
+import glob
+import os
+
+import numpy as np
+import rasterio
+
+from tensor_cache import tensor_folder_path
+from utils import get_fnames_labels, load_data
+
+
+def cache_files():
+    return sorted(glob.glob(os.path.join(tensor_folder_path(), '*.npy')))
+
+
+def test_cached_tensors_equal_the_patches(so2sat_data, workdir, capsys):
+    part1_path, _ = so2sat_data
+    train_path = os.path.join(part1_path, 'train')
+    for data, dtype in [('sen2_rgb_autumn', np.uint8), ('lu', np.float32), ('osm_features', np.float32)]:
+        x, pop, classes = get_fnames_labels(train_path, data, cache=False)
+        assert x.dtype == dtype
+        x_cached, pop_cached, classes_cached = get_fnames_labels(train_path, data)
+        assert isinstance(x_cached, np.memmap) and x_cached.dtype == dtype
+        np.testing.assert_array_equal(x_cached, x)
+        np.testing.assert_array_equal(pop_cached, pop)
+
+        capsys.readouterr()
+        np.testing.assert_array_equal(get_fnames_labels(train_path, data)[0], x)
+        assert 'loaded from' in capsys.readouterr().out
+    assert len(cache_files()) == 3
+
+
+def test_cache_is_copy_on_write(so2sat_data, workdir):
+    f_names = np.array(sorted(glob.glob(os.path.join(so2sat_data[0], 'train', '*', 'lcz', '*', '*'))))
+    x = load_data(f_names, channels=1)
+    expected = np.array(x)
+    x[:] = 0
+    np.testing.assert_array_equal(load_data(f_names, channels=1), expected)
+
+
+def test_changed_patch_invalidates_the_cache(so2sat_copy, workdir):
+    f_names = np.array(sorted(glob.glob(os.path.join(so2sat_copy[0], 'train', '*', 'viirs', '*', '*'))))
+    load_data(f_names, channels=1)
+    with rasterio.open(f_names[0], 'r+') as ds:
+        ds.write(np.full((1, ds.height, ds.width), 7, dtype=np.float32))
+    x = load_data(f_names, channels=1)
+    assert len(cache_files()) == 2
+    assert (x[0] == 7).all()
+    np.testing.assert_array_equal(x, load_data(f_names, channels=1, cache=False))
@@ -0,0 +1,95 @@
+import glob
+import json
+import os
+import shutil
+import _pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+
+import training_engine
+from constants import covariate_list
+from feature_store import load_feature_arrays
+from rf_regression import rf_regressor
+from training_engine import regressor_covariates, train_regressors
+from utils import append_features, feature_engineering
+
+from test_append_features import viirs_std
+
+
+@pytest.fixture
+def small_learners(monkeypatch, workdir):
+    # forests of a few trees and grids of a few points, the synthetic dataset has 12 training patches
+    monkeypatch.setitem(training_engine.selectors, 'random_forest',
+                        lambda: RandomForestRegressor(n_estimators=10, random_state=0))
+    monkeypatch.setitem(training_engine.selectors, 'gradient_boosting',
+                        lambda: GradientBoostingRegressor(n_estimators=10, random_state=0))
+    monkeypatch.setitem(training_engine.learners['random_forest'], 'param_grid',
+                        {'oob_score': [True], 'bootstrap': [True], 'max_features': ['sqrt', 0.4],
+                         'n_estimators': [4, 8]})
+    monkeypatch.setitem(training_engine.learners['gradient_boosting'], 'param_grid',
+                        {'max_depth': [2, 3], 'n_estimators': [4, 8]})
+
+
+def read_bundle(pred_csv_path):
+    model_folder = os.path.dirname(pred_csv_path)
+    model_name = os.path.basename(model_folder)
+    with open(os.path.join(model_folder, model_name), 'rb') as f:
+        regressor = _pickle.load(f)
+    with open(os.path.join(model_folder, model_name + '_covariates.txt')) as f:
+        list_covar = f.read().split()
+    with open(os.path.join(model_folder, model_name + '_provenance.json')) as f:
+        provenance = json.load(f)
+    return regressor, list_covar, provenance
+
+
+@pytest.mark.filterwarnings('ignore:Some inputs do not have OOB scores')
+def test_regressors_on_a_store_with_missing_modalities(so2sat_copy, small_learners):
+    part1_path, part2_path = so2sat_copy
+    # a training and the test city without Part2 patches: their dem features are missing from the store
+    for city_folder in [sorted(glob.glob(os.path.join(part2_path, split, '*')))[0] for split in ['train', 'test']]:
+        shutil.rmtree(os.path.join(city_folder, 'dem'))
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+
+    pred_csv_paths = train_regressors(feature_folder, ['random_forest', 'gradient_boosting'], ['grid', 'warm_grid'])
+    assert sorted(pred_csv_paths) == [(learner, hp_strategy) for learner in ['gradient_boosting', 'random_forest']
+                                      for hp_strategy in ['grid', 'warm_grid']]
+
+    x_test, _, test_df = load_feature_arrays(feature_folder, 'test', covariate_list, fill_value=0)
+    for (learner, hp_strategy), pred_csv_path in pred_csv_paths.items():
+        df_pred = pd.read_csv(pred_csv_path)
+        assert df_pred['GRD_ID'].tolist() == test_df['GRD_ID'].tolist()
+        assert df_pred['Predictions'].notna().all()
+        regressor, list_covar, provenance = read_bundle(pred_csv_path)
+        assert list_covar and set(list_covar) <= set(covariate_list)
+        assert provenance['n_covariates'] == len(list_covar) and provenance['n_samples'] == 12
+        columns = [covariate_list.index(covariate) for covariate in list_covar]
+        np.testing.assert_allclose(df_pred['Predictions'], regressor.predict(x_test[:, columns]), rtol=1e-6)
+    # the grid and the warm-start grid searches score the same candidates
+    for learner in ['random_forest', 'gradient_boosting']:
+        grid, warm = (pd.read_csv(pred_csv_paths[(learner, hp_strategy)]) for hp_strategy in ['grid', 'warm_grid'])
+        np.testing.assert_allclose(grid['Predictions'], warm['Predictions'], rtol=1e-6)
+
+
+@pytest.mark.filterwarnings('ignore:Some inputs do not have OOB scores')
+def test_regressors_request_appended_features_by_group(so2sat_data, small_learners):
+    part1_path, part2_path = so2sat_data
+    feature_folder = feature_engineering(part1_path, n_workers=1, part2_path=part2_path)
+    append_features(part1_path, 'viirs', viirs_std, ['VIIRS_STD'], 'texture', feature_folder=feature_folder)
+
+    covariates = ['VIIRS_MEAN', 'LU_1_A', 'LU_3_A']
+    assert regressor_covariates(feature_folder) == covariate_list
+    assert regressor_covariates(feature_folder, covariates, ['texture']) == covariates + ['VIIRS_STD']
+    with pytest.raises(ValueError):
+        regressor_covariates(feature_folder, covariates, ['not_a_group'])
+
+    pred_csv_path = rf_regressor(feature_folder, 'grid', covariates=covariates, feature_groups=['texture'])
+    selection_files = glob.glob(os.path.join(training_engine.selection_folder_path(), '*.json'))
+    with open(selection_files[0]) as f:
+        assert json.load(f)['covariates'] == covariates + ['VIIRS_STD']
+    regressor, list_covar, _ = read_bundle(pred_csv_path)
+    assert set(list_covar) <= set(covariates + ['VIIRS_STD'])
+    x_test, _, _ = load_feature_arrays(feature_folder, 'test', list_covar, fill_value=0)
+    np.testing.assert_allclose(pd.read_csv(pred_csv_path)['Predictions'], regressor.predict(x_test), rtol=1e-6)
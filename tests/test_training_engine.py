@@ -0,0 +1,72 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+import training_engine
+from constants import covariate_list
+from training_engine import select_covariates, selection_folder_path
+
+
+@pytest.fixture
+def small_selector(monkeypatch, workdir):
+    # 10 trees instead of 500, the cache key holds the hyperparameters of the selection model
+    monkeypatch.setitem(training_engine.selectors, 'random_forest',
+                        lambda: RandomForestRegressor(n_estimators=10, random_state=0))
+
+
+def training_data(seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.random((80, len(covariate_list))).astype(np.float32)
+    y = (100 * x[:, 3] + 50 * x[:, 7] + rng.random(80)).astype(np.float32)
+    return x, y
+
+
+def selection_files():
+    return sorted(glob.glob(os.path.join(selection_folder_path(), '*.json')))
+
+
+def test_selection_is_cached(small_selector, capsys):
+    x, y = training_data()
+    feature_idx, list_covar = select_covariates(x, y, 'random_forest')
+    assert len(selection_files()) == 1
+    assert list_covar == [covariate for covariate, selected in zip(covariate_list, feature_idx) if selected]
+    assert 'LU_1_A' in list_covar and 'VIIRS_MEAN' in list_covar
+
+    capsys.readouterr()
+    cached_idx, cached_covar = select_covariates(x, y, 'random_forest')
+    assert 'selected by the random_forest of' in capsys.readouterr().out
+    np.testing.assert_array_equal(cached_idx, feature_idx)
+    assert cached_covar == list_covar
+
+
+def test_selection_cache_is_invalidated_by_the_data(small_selector, capsys):
+    x, y = training_data()
+    select_covariates(x, y, 'random_forest')
+    y_changed = y.copy()
+    y_changed[0] += 1
+    x_changed = x.copy()
+    x_changed[0, 0] += 1
+    for new_x, new_y in [(x, y_changed), (x_changed, y)]:
+        capsys.readouterr()
+        select_covariates(new_x, new_y, 'random_forest')
+        assert 'Selecting the covariates' in capsys.readouterr().out
+    assert len(selection_files()) == 3
+
+
+def test_selection_cache_is_invalidated_by_the_model(small_selector, monkeypatch):
+    x, y = training_data()
+    select_covariates(x, y, 'random_forest')
+    monkeypatch.setitem(training_engine.selectors, 'random_forest',
+                        lambda: RandomForestRegressor(n_estimators=10, random_state=1))
+    select_covariates(x, y, 'random_forest')
+    assert len(selection_files()) == 2
+
+
+def test_selection_without_cache(small_selector):
+    x, y = training_data()
+    feature_idx, _ = select_covariates(x, y, 'random_forest', cache=False)
+    assert selection_files() == []
+    assert feature_idx.dtype == bool and len(feature_idx) == len(covariate_list)
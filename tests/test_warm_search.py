@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_regression
+from sklearn.ensemble import AdaBoostRegressor, GradientBoostingRegressor, RandomForestRegressor
+from sklearn.model_selection import GridSearchCV
+from sklearn.neural_network import MLPRegressor
+
+from training_engine import new_search
+from warm_search import WarmStartGridSearchCV
+
+# the forests of the tests are too small for every row to have an out-of-bag score
+pytestmark = pytest.mark.filterwarnings('ignore:Some inputs do not have OOB scores')
+
+searches = [
+    (RandomForestRegressor(random_state=0),
+     {'oob_score': [True], 'bootstrap': [True], 'max_features': ['sqrt', 0.4], 'n_estimators': [5, 8, 12]}),
+    (GradientBoostingRegressor(random_state=0),
+     {'loss': ['squared_error', 'huber'], 'max_depth': [2, 3], 'n_estimators': [5, 8, 12],
+      'max_features': ['sqrt', 0.4]}),
+    (AdaBoostRegressor(random_state=0),
+     {'learning_rate': [0.1, 1.0], 'n_estimators': [5, 8, 12], 'loss': ['linear', 'square']}),
+]
+
+
+@pytest.fixture(scope='module')
+def regression_data():
+    x, y = make_regression(150, 8, noise=5, random_state=0)
+    return x.astype(np.float32), y.astype(np.float32)
+
+
+@pytest.mark.parametrize('estimator, param_grid', searches, ids=['random_forest', 'gradient_boosting', 'adaboost'])
+def test_warm_start_search_equals_grid_search(regression_data, estimator, param_grid):
+    x, y = regression_data
+    grid = GridSearchCV(estimator, param_grid, cv=3, n_jobs=1).fit(x, y)
+    warm = WarmStartGridSearchCV(estimator, param_grid, cv=3, n_jobs=1).fit(x, y)
+
+    assert warm.cv_results_['params'] == grid.cv_results_['params']
+    for key in ['mean_test_score', 'std_test_score', 'split0_test_score', 'split1_test_score', 'split2_test_score']:
+        np.testing.assert_allclose(warm.cv_results_[key], grid.cv_results_[key], rtol=1e-12, atol=1e-12)
+    np.testing.assert_array_equal(warm.cv_results_['rank_test_score'], grid.cv_results_['rank_test_score'])
+    for name in param_grid:
+        assert list(warm.cv_results_['param_' + name]) == list(grid.cv_results_['param_' + name])
+    assert set(warm.cv_results_) == set(grid.cv_results_)
+    assert warm.best_index_ == grid.best_index_ and warm.best_params_ == grid.best_params_
+    assert warm.best_score_ == pytest.approx(grid.best_score_)
+    np.testing.assert_array_equal(warm.best_estimator_.predict(x), grid.best_estimator_.predict(x))
+    assert warm.refit_time_ >= 0
+
+
+def test_warm_start_search_needs_an_ensemble():
+    with pytest.raises(ValueError):
+        WarmStartGridSearchCV(MLPRegressor(), {'alpha': [1e-4, 1e-3]})
+    with pytest.raises(ValueError):
+        WarmStartGridSearchCV(RandomForestRegressor(), {'max_features': ['sqrt']})
+
+
+@pytest.mark.parametrize('learner, search_type', [('random_forest', WarmStartGridSearchCV),
+                                                  ('adaboost', WarmStartGridSearchCV),
+                                                  ('gradient_boosting', WarmStartGridSearchCV),
+                                                  ('voting', GridSearchCV), ('mlp', GridSearchCV)])
+def test_new_search_falls_back_to_grid_search(learner, search_type):
+    assert type(new_search(learner, 'warm_grid')) is search_type
+    with pytest.raises(ValueError):
+        new_search(learner, 'random')
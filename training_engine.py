@@ -0,0 +1,398 @@
+# training engine shared by all the regressors: the features are loaded and selected once, then the hyperparameter
+# search of every requested learner and tuning strategy runs in the same process. Each run writes its own bundle
+# (model, covariates, training log, predictions, feature importance plot) to rf_logs, as the regressors always did.
+import hashlib
+import json
+import os
+import time
+import _pickle
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor, AdaBoostRegressor, VotingRegressor
+from sklearn.neural_network import MLPRegressor
+from sklearn.feature_selection import SelectFromModel
+from sklearn.utils.validation import check_is_fitted
+from sklearn.exceptions import NotFittedError
+
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV
+
+from atomic_io import atomic_write, atomic_write_json
+from utils import plot_feature_importance
+from warm_search import WarmStartGridSearchCV, warm_start_supported
+from feature_store import feature_group_names, feature_names, load_feature_arrays
+from feature_spec import write_covariates
+from constants import (min_fimportance, kfold, n_jobs, covariate_list, current_dir_path, ground_truth_col_reg,
+                       param_grid, param_grid_adaboost, param_grid_gradientboosting, params_grid_voting,
+                       params_grid_mlp, file_name_reg, file_name_ada, file_name_gb, file_name_voting, file_name_mlp)
+
+tuning_strategies = ['grid', 'halving', 'warm_grid']
+# columns of the feature store that are not covariates: the ids of the patches and the response variables
+id_columns = ['CITY', 'GRD_ID', 'POP', 'POP_DENS', 'LOG_POP_DENS']
+
+
+def random_forest_500():
+    """
+    :return: 500 trees random forest regressor, random_state is fixed to allow exact replication
+    """
+    return RandomForestRegressor(n_estimators=500, oob_score=True, n_jobs=-1, random_state=0)
+
+
+def adaboost_500():
+    """
+    :return: 500 stages adaboost regressor, random_state is fixed to allow exact replication
+    """
+    return AdaBoostRegressor(n_estimators=500, random_state=0)
+
+
+def gradient_boosting_500():
+    """
+    :return: 500 stages gradient boosting regressor, random_state is fixed to allow exact replication
+    """
+    return GradientBoostingRegressor(n_estimators=500, random_state=0)
+
+
+def new_voting():
+    """
+    :return: voting regressor of the 500 estimators adaboost, random forest and gradient boosting
+    """
+    return VotingRegressor(estimators=[('ada', adaboost_500()), ('rf', random_forest_500()),
+                                       ('gb', gradient_boosting_500())], n_jobs=-1)
+
+
+# learners of the engine: the estimator tuned by the search (random_state fixed to allow exact replication), its
+# parameter grid, the model selecting the covariates (see selectors), the maximum resources of the halving search and
+# the name of the bundle
+learners = {
+    'random_forest': {'estimator': partial(RandomForestRegressor, random_state=0), 'param_grid': param_grid,
+                      'selector': 'random_forest', 'max_resources': 50, 'file_name': file_name_reg,
+                      'title': 'Random Forest'},
+    'adaboost': {'estimator': partial(AdaBoostRegressor, random_state=0), 'param_grid': param_grid_adaboost,
+                 'selector': 'adaboost', 'max_resources': 50, 'file_name': file_name_ada, 'title': 'AdaBoost'},
+    'gradient_boosting': {'estimator': partial(GradientBoostingRegressor, random_state=0),
+                          'param_grid': param_grid_gradientboosting, 'selector': 'gradient_boosting',
+                          'max_resources': 50, 'file_name': file_name_gb, 'title': 'Gradient Boosting'},
+    'voting': {'estimator': new_voting, 'param_grid': params_grid_voting, 'selector': 'random_forest',
+               'max_resources': 75, 'file_name': file_name_voting, 'title': 'Voting'},
+    'mlp': {'estimator': partial(MLPRegressor, random_state=1), 'param_grid': params_grid_mlp,
+            'selector': 'random_forest', 'max_resources': 75, 'file_name': file_name_mlp, 'title': 'MLP'},
+}
+
+# models fitted by SelectFromModel to select the covariates
+selectors = {'random_forest': random_forest_500, 'adaboost': adaboost_500, 'gradient_boosting': gradient_boosting_500}
+
+
+def selection_folder_path():
+    """
+    :return: path to the folder of the cached covariate selections, in the current folder
+    """
+    return os.path.join(current_dir_path, 'So2Sat_POP_selection')
+
+
+def selection_key(x, y, selector, model, covariates=covariate_list):
+    """
+    :param x: training covariates
+    :param y: training ground truth
+    :param selector: name of the selection model
+    :param model: selection model, its hyperparameters (random_state included) are part of the key
+    :param covariates: names of the columns of x
+    :return: sha1 of the training data, the covariate names, the selection model and its hyperparameters
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(x))
+    sha1.update(np.ascontiguousarray(y))
+    sha1.update(repr((x.shape, str(x.dtype), str(y.dtype), list(covariates), selector,
+                      sorted(model.get_params().items()))).encode())
+    return sha1.hexdigest()
+
+
+def select_covariates(x, y, selector, cache=True, covariates=covariate_list):
+    """
+    :param x: training covariates, shape (patches, len(covariates))
+    :param y: training ground truth
+    :param selector: name of the selection model, see selectors
+    :param cache: if True, the importances of the selection model are saved and reused by the next runs on the same
+    data with the same model, see selection_key; min_fimportance can change between the runs
+    :param covariates: names of the columns of x
+    :return: boolean mask of the covariates whose importance is above min_fimportance, list of their names
+    """
+    model = selectors[selector]()
+    selection_file = os.path.join(selection_folder_path(), '{}_{}.json'.format(
+        selector, selection_key(x, y, selector, model, covariates)[:20]))
+    if cache and os.path.isfile(selection_file):
+        with open(selection_file) as f:
+            importances = np.array(json.load(f)['importances'])
+        print("Covariates selected by the {} of {}\n".format(selector, selection_file))
+    else:
+        print("Selecting the covariates with a 500 estimators {}...\n".format(selector))
+        sel = SelectFromModel(model, threshold=min_fimportance)
+        importances = sel.fit(x, y).estimator_.feature_importances_
+        if cache:
+            os.makedirs(selection_folder_path(), exist_ok=True)
+            atomic_write_json(selection_file, {'selector': selector, 'params': {key: repr(value) for key, value in
+                                                                                model.get_params().items()},
+                                               'covariates': list(covariates), 'importances': importances.tolist()},
+                              indent=1)
+    # Get list of T/F for covariates for which OOB score is upper the threshold, as SelectFromModel.get_support
+    feature_idx = importances >= min_fimportance
+    # Get list of covariates with the selected features
+    list_covar = [covariate for covariate, selected in zip(covariates, feature_idx) if selected]
+    return feature_idx, list_covar
+
+
+def new_search(learner, hp_strategy):
+    """
+    :param learner: name of the learner, see learners
+    :param hp_strategy: tuning strategy, 'grid', 'halving' or 'warm_grid' (grid search growing one ensemble over the
+    n_estimators values, see WarmStartGridSearchCV; grid search for the learners without n_estimators to grow)
+    :return: hyperparameter search of the learner with cross validation
+    """
+    spec = learners[learner]
+    if hp_strategy == 'warm_grid':
+        estimator = spec['estimator']()
+        if warm_start_supported(estimator, spec['param_grid']):
+            return WarmStartGridSearchCV(estimator=estimator, param_grid=spec['param_grid'], cv=kfold, n_jobs=n_jobs,
+                                         verbose=0)
+        print("No n_estimators to grow for {}, falling back to the grid search".format(spec['title']))
+        hp_strategy = 'grid'
+    if hp_strategy == 'grid':
+        return GridSearchCV(estimator=spec['estimator'](), param_grid=spec['param_grid'], cv=kfold, n_jobs=n_jobs,
+                            verbose=0)
+    if hp_strategy == 'halving':
+        return HalvingGridSearchCV(estimator=spec['estimator'](), param_grid=spec['param_grid'], cv=kfold,
+                                   n_jobs=n_jobs, verbose=0, factor=2, max_resources=spec['max_resources'])
+    raise ValueError('Unknown tuning strategy {}, expected one of {}'.format(hp_strategy, tuning_strategies))
+
+
+def new_model_folder(file_name):
+    """
+    :param file_name: suffix of the bundle, ex: 'rf_reg'
+    :return: path to a new folder rf_logs/<time stamp>_<file_name>, name of the model
+    """
+    rf_model_folder = os.path.join(current_dir_path, "rf_logs")  # path to the folder "rf_model"
+    if not os.path.exists(rf_model_folder):
+        os.mkdir(rf_model_folder)  # creates rf_logs folder inside the project folder
+    model_name = time.strftime("%Y%m%d-%H%M%S_") + file_name  # model name
+    while os.path.exists(os.path.join(rf_model_folder, model_name)):  # same learner finished within the second
+        time.sleep(1)
+        model_name = time.strftime("%Y%m%d-%H%M%S_") + file_name
+    model_folder = os.path.join(rf_model_folder, model_name)
+    os.mkdir(model_folder)  # creates folder inside the rf_logs folder, named as per time stamp and file_name
+    return model_folder, model_name
+
+
+def best_regressor(search, x, y):
+    """
+    :param search: fitted hyperparameter search
+    :param x: training covariates the search was fitted on
+    :param y: training ground truth
+    :return: best regressor fitted on all the training data, reused from the refit of the search and fitted only if
+    the search did not refit it; provenance of the fitted regressor: who fitted it, on which data, in how long
+    """
+    regressor = search.best_estimator_
+    try:
+        check_is_fitted(regressor)
+        fitted_by = '{} refit'.format(type(search).__name__)
+        fit_duration = search.refit_time_
+    except NotFittedError:
+        start = time.time()
+        regressor.fit(x, y)  # Fit the best regressor with the data
+        fit_duration = time.time() - start
+        fitted_by = 'train_learner'
+    provenance = {'estimator': type(regressor).__name__, 'fitted_by': fitted_by, 'fit_duration': fit_duration,
+                  'best_params': {key: repr(value) for key, value in search.best_params_.items()},
+                  'n_samples': int(x.shape[0]), 'n_covariates': int(x.shape[1]), 'data_dtype': str(x.dtype),
+                  'fitted': time.strftime("%Y%m%d-%H%M%S")}
+    return regressor, provenance
+
+
+def save_model(regressor, rf_model_path):
+    """
+    Pickles the regressor atomically, so that a partially written model is never loaded
+    :param regressor: fitted regressor
+    :param rf_model_path: path to the saved model
+    :return: rf_model_path
+    """
+    def write_model(tmp_file):
+        with open(tmp_file, 'wb') as f:
+            _pickle.dump(regressor, f)
+
+    return atomic_write(rf_model_path, write_model)
+
+
+def training_log(learner, search, regressor, fit_duration):
+    """
+    :param learner: name of the learner
+    :param search: fitted hyperparameter search
+    :param regressor: best regressor fitted on all the training data
+    :param fit_duration: training time of the best regressor in seconds, the refit of the search
+    :return: text of the training log
+    """
+    spec = learners[learner]
+    # mean cross-validated score (OOB) and stddev of the best_estimator
+    best_score = search.cv_results_['mean_test_score'][search.best_index_]
+    best_std = search.cv_results_['std_test_score'][search.best_index_]
+
+    log = ""
+    message = 'Parameter grid for %s tuning :\n' % spec['title']
+    for key in spec['param_grid'].keys():
+        message += '    ' + key + ' : ' + ', '.join([str(i) for i in list(spec['param_grid'][key])]) + '\n'
+    message += '    ' + 'min_fimportance' + ' : ' + str(min_fimportance) + '\n'
+    log += message + '\n'
+
+    message = 'Optimized parameters for %s after grid search %s-fold cross-validation tuning :\n' % (
+        spec['title'], kfold)
+    for key in search.best_params_.keys():
+        message += '    %s : %s' % (key, search.best_params_[key]) + '\n'
+    log += message + '\n'
+
+    message = "Mean cross-validated score (OOB) and stddev of the best_estimator : %0.3f (+/-%0.3f)" % (
+        best_score, best_std) + '\n'
+    log += message + '\n'
+
+    # Print mean OOB and stddev for each set of parameters
+    means = search.cv_results_['mean_test_score']
+    stds = search.cv_results_['std_test_score']
+    message = "Mean cross-validated score (OOB) and stddev for every tested set of parameter :\n"
+    for mean, std, params in zip(means, stds, search.cv_results_['params']):
+        message += "%0.3f (+/-%0.03f) for %r" % (mean, std, params) + '\n'
+    log += message + '\n'
+
+    if getattr(regressor, 'oob_score_', None) is not None:  # Print final model OOB
+        log += 'Final %s model run - internal Out-of-bag score (OOB) : %0.3f' % (spec['title'],
+                                                                                regressor.oob_score_) + '\n'
+    log += "Training time of best: " + str(fit_duration) + "s\n"
+    return log
+
+
+def train_learner(learner, hp_strategy, x, y, list_covar, x_test, test_df, seed=0):
+    """
+    Tunes one learner on the selected covariates, saves its bundle and predicts the test cities
+    :param learner: name of the learner, see learners
+    :param hp_strategy: tuning strategy, see tuning_strategies
+    :param x: training covariates, selected columns only
+    :param y: training ground truth
+    :param list_covar: names of the selected covariates
+    :param x_test: test covariates, selected columns only
+    :param test_df: data frame of the CITY and GRD_ID of the test rows
+    :param seed: seed of numpy, set before the search as every regressor did
+    :return: prediction csv path
+    """
+    spec = learners[learner]
+    np.random.seed(seed)
+
+    # Instantiate the grid search model
+    print("Starting {} search of {} with cross validation...\n".format(hp_strategy, spec['title']))
+    search = new_search(learner, hp_strategy)
+    search.fit(x, y)  # Fit the grid search to the data
+    regressor, provenance = best_regressor(search, x, y)  # the best regressor, refitted on all the data by the search
+    fit_duration = provenance['fit_duration']
+    print(f"Training time of best: {fit_duration}s")
+
+    model_folder, model_name = new_model_folder(spec['file_name'])
+    rf_model_path = os.path.join(model_folder, model_name)  # path to saved model
+
+    # save the best regressor in the background, the predictions use the fitted regressor in memory
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        saved = executor.submit(save_model, regressor, rf_model_path)
+
+        # save the selected covariates, feature_engineering(..., covariates=read_covariates(path)) computes only these
+        write_covariates(list_covar, os.path.join(model_folder, '%s_covariates.txt' % model_name))
+
+        # Save the log and the provenance of the saved model
+        with open(os.path.join(model_folder, '%s_training_log.txt' % model_name), 'w') as fout:
+            fout.write(training_log(learner, search, regressor, fit_duration))
+        with open(os.path.join(model_folder, '%s_provenance.json' % model_name), 'w') as fout:
+            json.dump(provenance, fout, indent=1)
+
+        # Start the predictions on completely unseen test data set
+        print("Starting testing...\n")
+        # Predict on test data set
+        start = time.time()
+        prediction = regressor.predict(x_test)
+        stop = time.time()
+        inference_duration = stop - start
+        print(f"Inference time of best: {inference_duration}s")
+
+        # Save the prediction
+        df_pred = pd.DataFrame()
+        df_pred["CITY"] = test_df['CITY']
+        df_pred["GRD_ID"] = test_df['GRD_ID']
+        df_pred['Predictions'] = prediction
+
+        pred_csv_path = os.path.join(model_folder, '%s_predictions.csv' % model_name)
+        df_pred.to_csv(pred_csv_path, index=False)
+
+        if hasattr(regressor, 'feature_importances_'):  # not defined for the voting and mlp regressors
+            print("Creation of feature importance plot...\n")
+            importances = regressor.feature_importances_  # Save feature importances from the model
+            path_plot = os.path.join(model_folder, "%s_RF_feature_importance" % model_name)  # path to saved plot
+            plot_feature_importance(importances, list_covar, path_plot)
+        saved.result()  # the bundle is complete once the model is saved, raises the error of the save if any
+    return pred_csv_path
+
+
+def regressor_covariates(feature_folder, covariates=None, feature_groups=None):
+    """
+    :param feature_folder: path to feature folder
+    :param covariates: names of the feature columns, None for covariate_list
+    :param feature_groups: names of groups of features of the feature store, their columns are added to the
+    covariates, ex: ['texture'] after append_features(..., 'texture'); see feature_store.feature_names
+    :return: names of the covariates the regressors select from, in the order of the columns of X
+    """
+    covariates = list(covariate_list if covariates is None else covariates)
+    for group in feature_groups or []:
+        group_columns = feature_names(feature_folder, group)
+        if not group_columns:
+            raise ValueError('No feature group {} in the feature store {}, expected one of {}'.format(
+                group, feature_folder, feature_group_names(feature_folder)))
+        covariates += [column for column in group_columns if column not in covariates and column not in id_columns]
+    return covariates
+
+
+def train_regressors(feature_folder, learner_names, hp_strategies, seed=0, covariates=None, feature_groups=None):
+    """
+    Trains every learner with every tuning strategy on the same data: the features of the training and test cities
+    are read once and each selection model is fitted once, whatever the number of learners using it
+    :param feature_folder: path to feature folder
+    :param learner_names: list of learners, see learners, ex: ['random_forest', 'adaboost']
+    :param hp_strategies: list of tuning strategies, see tuning_strategies
+    :param seed: seed of numpy, set before every search
+    :param covariates: names of the feature columns the covariates are selected from, None for covariate_list
+    :param feature_groups: names of groups of features of the feature store whose columns are added to the
+    covariates, see regressor_covariates
+    :return: dictionary (learner, tuning strategy) -> prediction csv path
+    """
+    for learner in learner_names:
+        if learner not in learners:
+            raise ValueError('Unknown learner {}, expected one of {}'.format(learner, list(learners)))
+    for hp_strategy in hp_strategies:
+        if hp_strategy not in tuning_strategies:
+            raise ValueError('Unknown tuning strategy {}, expected one of {}'.format(hp_strategy, tuning_strategies))
+
+    covariates = regressor_covariates(feature_folder, covariates, feature_groups)
+    print("Starting regression")
+    # independent variables x and dependent variable y, float32 with the missing features set to 0
+    x, y, _ = load_feature_arrays(feature_folder, 'train', covariates, target=ground_truth_col_reg, fill_value=0)
+    # all the covariates of the test cities, each learner takes the columns it selected; the missing features are set
+    # to 0 as in the training data
+    x_test_all, _, test_df = load_feature_arrays(feature_folder, 'test', covariates, fill_value=0)
+
+    print("Starting training...\n")
+    selections = {}  # selection model -> (mask, names) of the selected covariates
+    pred_csv_paths = {}
+    for learner in learner_names:
+        selector = learners[learner]['selector']
+        if selector not in selections:
+            selections[selector] = select_covariates(x, y, selector, covariates=covariates)
+        feature_idx, list_covar = selections[selector]
+        x_selected = np.ascontiguousarray(x[:, feature_idx])  # Update the data with the selected features only
+        x_test = np.ascontiguousarray(x_test_all[:, feature_idx])
+        for hp_strategy in hp_strategies:
+            pred_csv_paths[(learner, hp_strategy)] = train_learner(learner, hp_strategy, x_selected, y, list_covar,
+                                                                   x_test, test_df, seed)
+    return pred_csv_paths
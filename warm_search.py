@@ -0,0 +1,144 @@
+# grid search over n_estimators without refitting the ensembles from scratch: for every combination of the other
+# parameters and every fold, one ensemble is grown up to the largest n_estimators of the grid and scored at each
+# n_estimators of the grid on the way, with warm_start (random forest, gradient boosting) or with the staged
+# predictions of the ensemble (adaboost). The results have the structure of the GridSearchCV ones.
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
+
+from sklearn.base import clone
+from sklearn.metrics import r2_score
+from sklearn.model_selection import ParameterGrid, check_cv
+
+
+def warm_start_supported(estimator, param_grid):
+    """
+    :param estimator: estimator of the search
+    :param param_grid: dictionary parameter name -> list of values
+    :return: True if the grid sweeps n_estimators and the estimator can grow its ensemble (warm_start) or predict
+    with its first stages only (staged_predict)
+    """
+    return (isinstance(param_grid, dict) and 'n_estimators' in param_grid and
+            ('warm_start' in estimator.get_params() or hasattr(estimator, 'staged_predict')))
+
+
+def sweep_n_estimators(estimator, params, n_estimators, x, y, train, test):
+    """
+    Grows one ensemble on the train rows and scores it on the test rows at every checkpoint. The ensemble grown up to
+    a checkpoint is the one fitted from scratch with that n_estimators, the random_state draws of the first estimators
+    are the same.
+    :param estimator: estimator of the search
+    :param params: values of the parameters of the grid other than n_estimators
+    :param n_estimators: sorted list of the n_estimators checkpoints
+    :param x: training covariates
+    :param y: training ground truth
+    :param train: indices of the train rows of the fold
+    :param test: indices of the test rows of the fold
+    :return: list of (R2 score, fit time, score time) per checkpoint; the fit time is the time to grow the ensemble
+    up to the checkpoint
+    """
+    model = clone(estimator).set_params(**params)
+    results = []
+    if 'warm_start' in model.get_params():
+        # the out-of-bag score is not used by the search, it would be computed again at every checkpoint
+        model.set_params(warm_start=True, **({'oob_score': False} if 'oob_score' in model.get_params() else {}))
+        fit_time = 0.0
+        for n in n_estimators:
+            start = time.time()
+            model.set_params(n_estimators=n).fit(x[train], y[train])  # adds n - len(estimators_) estimators
+            fit_time += time.time() - start
+            start = time.time()
+            score = model.score(x[test], y[test])
+            results.append((score, fit_time, time.time() - start))
+        return results
+
+    start = time.time()
+    model.set_params(n_estimators=n_estimators[-1]).fit(x[train], y[train])
+    fit_time = time.time() - start
+    start = time.time()
+    prediction = None
+    for stage, prediction in enumerate(model.staged_predict(x[test]), start=1):
+        if stage == n_estimators[len(results)]:
+            results.append((r2_score(y[test], prediction), fit_time * stage / n_estimators[-1], time.time() - start))
+            if len(results) == len(n_estimators):
+                break
+    while len(results) < len(n_estimators):  # boosting stopped early, the larger ensembles are the same
+        results.append((r2_score(y[test], prediction), fit_time, time.time() - start))
+    return results
+
+
+class WarmStartGridSearchCV:
+    """
+    Exhaustive search over param_grid with cross validation, scored with R2 as GridSearchCV scores the regressors,
+    where the n_estimators values share one ensemble per combination of the other parameters and fold. Exposes the
+    cv_results_, best_index_, best_params_, best_score_, best_estimator_ and refit_time_ of GridSearchCV.
+    """
+
+    def __init__(self, estimator, param_grid, cv=None, n_jobs=None, verbose=0):
+        """
+        :param estimator: random forest, gradient boosting or adaboost regressor, see warm_start_supported
+        :param param_grid: dictionary parameter name -> list of values, n_estimators included
+        :param cv: number of folds or cross validation splitter, as for GridSearchCV
+        :param n_jobs: number of (parameters, fold) ensembles grown in parallel
+        :param verbose: verbosity of joblib
+        """
+        if not warm_start_supported(estimator, param_grid):
+            raise ValueError('Warm start search needs an n_estimators grid and an estimator with warm_start or '
+                             'staged_predict, got {}'.format(type(estimator).__name__))
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+
+    def fit(self, x, y):
+        """
+        :param x: training covariates
+        :param y: training ground truth
+        :return: self, with best_estimator_ refitted on all the training data
+        """
+        n_estimators = sorted(set(self.param_grid['n_estimators']))
+        other_grid = list(ParameterGrid({key: values for key, values in self.param_grid.items()
+                                         if key != 'n_estimators'}))
+        folds = list(check_cv(self.cv, y, classifier=False).split(x, y))
+        print("Fitting {} folds for each of {} ensembles grown up to {} estimators, {} candidates".format(
+            len(folds), len(other_grid), n_estimators[-1], len(other_grid) * len(n_estimators)))
+        sweeps = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+            delayed(sweep_n_estimators)(self.estimator, params, n_estimators, x, y, train, test)
+            for params in other_grid for train, test in folds)
+        sweeps = np.array(sweeps).reshape(len(other_grid), len(folds), len(n_estimators), 3)
+
+        # candidates in the order of GridSearchCV
+        candidates = list(ParameterGrid(self.param_grid))
+        scores = np.empty((len(candidates), len(folds), 3))
+        for k, params in enumerate(candidates):
+            other = {key: value for key, value in params.items() if key != 'n_estimators'}
+            scores[k] = sweeps[other_grid.index(other), :, n_estimators.index(params['n_estimators'])]
+
+        results = {}
+        for key, values in (('fit_time', scores[:, :, 1]), ('score_time', scores[:, :, 2])):
+            results['mean_' + key] = values.mean(axis=1)
+            results['std_' + key] = values.std(axis=1)
+        for name in sorted(self.param_grid):
+            param = np.ma.MaskedArray(np.empty(len(candidates), dtype=object), mask=False)
+            param[:] = [params[name] for params in candidates]
+            results['param_' + name] = param
+        results['params'] = candidates
+        for fold in range(len(folds)):
+            results['split%d_test_score' % fold] = scores[:, fold, 0]
+        results['mean_test_score'] = scores[:, :, 0].mean(axis=1)
+        results['std_test_score'] = scores[:, :, 0].std(axis=1)
+        results['rank_test_score'] = rankdata(-results['mean_test_score'], method='min').astype(np.int32)
+        self.cv_results_ = results
+        self.n_splits_ = len(folds)
+
+        self.best_index_ = int(results['rank_test_score'].argmin())
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = results['mean_test_score'][self.best_index_]
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        start = time.time()
+        self.best_estimator_.fit(x, y)
+        self.refit_time_ = time.time() - start
+        return self